@@ -1,31 +1,81 @@
-from typing import Optional
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
 
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
 from jose import JWTError, jwt
 
 from app.config import settings
-from app.db import get_db, get_user_by_id
+from app.db import get_pool, get_user_by_id
 
 security = HTTPBearer(auto_error=False)
 
 
+class _TokenCache:
+    """LRU of already-validated tokens, each entry expiring with the token's own `exp`.
+
+    Keys are blake2b digests so raw bearer tokens are never held in memory.
+    """
+
+    def __init__(self, maxsize: int = 10_000) -> None:
+        self.maxsize = maxsize
+        self._entries: "OrderedDict[str, Tuple[float, dict]]" = OrderedDict()
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+    def get(self, token: str) -> Optional[dict]:
+        key = self._key(token)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, user = entry
+        if expires_at <= time.time():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return user
+
+    def set(self, token: str, user: dict, expires_at: float) -> None:
+        if expires_at <= time.time():
+            return
+        key = self._key(token)
+        self._entries[key] = (expires_at, user)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def discard(self, token: str) -> None:
+        self._entries.pop(self._key(token), None)
+
+
+token_cache = _TokenCache(settings.token_cache_size)
+
+
 async def _decode_user(token: str) -> dict:
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
     try:
         payload = jwt.decode(token, settings.jwt_secret, algorithms=[settings.jwt_algorithm])
     except JWTError:
+        token_cache.discard(token)
         raise HTTPException(status_code=401, detail="Invalid or expired token")
     user_id = payload.get("sub")
     if not user_id:
+        token_cache.discard(token)
         raise HTTPException(status_code=401, detail="Invalid token")
-    conn = await get_db()
-    try:
+    pool = await get_pool()
+    async with pool.acquire() as conn:
         user = await get_user_by_id(conn, user_id)
-        if not user:
-            raise HTTPException(status_code=401, detail="User not found")
-        return user
-    finally:
-        await conn.close()
+    if not user:
+        token_cache.discard(token)
+        raise HTTPException(status_code=401, detail="User not found")
+    token_cache.set(token, user, float(payload.get("exp", 0)))
+    return user
 
 
 async def get_current_user(
@@ -1,21 +1,41 @@
+import asyncio
 import hashlib
+import hmac
+import os
 import time
 import uuid
+from typing import Optional, Tuple
 
 from fastapi import APIRouter, HTTPException, status
 from jose import jwt
 
 from app.config import settings
-from app.db import get_db, create_user, get_user_by_username
+from app.db import get_pool, create_user, get_user_by_username, update_user_password
 from app.schemas import TokenResponse, UserLogin, UserRegister
 
 router = APIRouter(prefix="/users", tags=["auth"])
 
+SCRYPT_N, SCRYPT_R, SCRYPT_P = 2**14, 8, 1
 
-def _hash_password(password: str) -> str:
+
+def _hash_password(password: str, salt: Optional[str] = None) -> Tuple[str, str]:
+    """Returns (hash_hex, salt_hex). Pass the stored salt to verify, omit it to hash a new password."""
+    salt_bytes = bytes.fromhex(salt) if salt else os.urandom(16)
+    digest = hashlib.scrypt(password.encode(), salt=salt_bytes, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P)
+    return digest.hex(), salt_bytes.hex()
+
+
+def _legacy_hash_password(password: str) -> str:
     return hashlib.sha256(f"{password}{settings.jwt_secret}".encode()).hexdigest()
 
 
+async def _verify_password(password: str, user: dict) -> bool:
+    if not user.get("password_salt"):
+        return hmac.compare_digest(user["password_hash"], _legacy_hash_password(password))
+    pw_hash, _ = await asyncio.to_thread(_hash_password, password, user["password_salt"])
+    return hmac.compare_digest(user["password_hash"], pw_hash)
+
+
 def _create_token(user_id: str, username: str) -> str:
     payload = {
         "sub": user_id,
@@ -29,31 +49,29 @@ def _create_token(user_id: str, username: str) -> str:
 async def register(data: UserRegister):
     if not data.username or not data.password:
         raise HTTPException(status_code=400, detail="Username and password required")
-    conn = await get_db()
-    try:
+    pool = await get_pool()
+    async with pool.acquire() as conn:
         existing = await get_user_by_username(conn, data.username)
         if existing:
             raise HTTPException(status_code=400, detail="Username already taken")
         user_id = str(uuid.uuid4())
-        pw_hash = _hash_password(data.password)
-        await create_user(conn, user_id, data.username, pw_hash)
+        pw_hash, pw_salt = await asyncio.to_thread(_hash_password, data.password)
+        await create_user(conn, user_id, data.username, pw_hash, pw_salt)
         token = _create_token(user_id, data.username)
         return TokenResponse(access_token=token, user_id=user_id, username=data.username)
-    finally:
-        await conn.close()
 
 
 @router.post("/login", response_model=TokenResponse)
 async def login(data: UserLogin):
-    conn = await get_db()
-    try:
+    pool = await get_pool()
+    async with pool.acquire() as conn:
         user = await get_user_by_username(conn, data.username)
         if not user:
             raise HTTPException(status_code=401, detail="Invalid credentials")
-        pw_hash = _hash_password(data.password)
-        if user["password_hash"] != pw_hash:
+        if not await _verify_password(data.password, user):
             raise HTTPException(status_code=401, detail="Invalid credentials")
+        if not user.get("password_salt"):
+            pw_hash, pw_salt = await asyncio.to_thread(_hash_password, data.password)
+            await update_user_password(conn, user["id"], pw_hash, pw_salt)
         token = _create_token(user["id"], user["username"])
         return TokenResponse(access_token=token, user_id=user["id"], username=user["username"])
-    finally:
-        await conn.close()
@@ -7,19 +7,47 @@ class Settings(BaseSettings):
     ollama_chat_model: str = "llama3.1:8b"
     ollama_json_model: str = "mistral:7b"
     ollama_embed_model: str = "nomic-embed-text"
+    embed_batch_size: int = 32
+    embed_concurrency: int = 8
 
     # Retrieval
     hyde_enabled: bool = True
+    hyde_cache_size: int = 1024
+    hyde_cache_path: str = "vectorstore/hyde_cache.mpk"
+    hyde_max_query_tokens: int = 30  # longer queries are embedded directly
     retrieval_k: int = 6
     retrieval_fetch_k: int = 20
     ensemble_bm25_weight: float = 0.35
     ensemble_faiss_weight: float = 0.65
+    faiss_index_factory: str = "IVF256,PQ32"  # "Flat" keeps every shard exact
+    faiss_train_min: int = 10_000  # vectors before a shard is retrained into faiss_index_factory
+    faiss_sq_factory: str = "SQ8"  # mid-size shards; "Flat" keeps them exact
+    faiss_sq_min: int = 1000  # enough samples to calibrate per-dimension int8 ranges
+    faiss_nprobe: int = 8
+    index_cache_users: int = 32  # users whose shard, BM25 corpus/index and retriever stay in RAM
+    reranker_model: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    reranker_onnx: bool = True  # int8 ONNX Runtime session when onnxruntime/optimum are installed
+    reranker_dir: str = "models/reranker"
+    reranker_max_length: int = 256  # query + 300-char child chunk fits well inside this
+    reranker_batch_requests: int = 32  # concurrent /ask rerank calls coalesced into one forward pass
+    reranker_batch_window_ms: float = 5.0  # how long the first queued request waits for company
+    semantic_cache_enabled: bool = True
+    semantic_cache_size: int = 2048  # answers held in-process across all users
+    semantic_cache_similarity: float = 0.95  # min cosine between query embeddings
+    semantic_cache_overlap: float = 0.8  # min Jaccard between retrieved chunk sets
 
     # Chunking
     parent_chunk_size: int = 1500
     parent_chunk_overlap: int = 100
     child_chunk_size: int = 300
     child_chunk_overlap: int = 30
+    use_nltk: bool = False  # NLTK punkt sentence splitting instead of the regex splitter
+
+    # Knowledge graph
+    graph_checkpoint_every: int = 1000  # delta-log records before a full checkpoint
+    graph_cache_users: int = 64  # per-user graphs held in RAM; others reload from disk on access
+    graph_llm_concurrency: int = 8  # upload chunks extracted at once; queries bypass this limit
+    graph_llm_retries: int = 2
 
     # Memory
     memory_confidence_threshold: float = 0.80
@@ -28,12 +56,16 @@ class Settings(BaseSettings):
     jwt_secret: str = "change-me-in-production"
     jwt_algorithm: str = "HS256"
     jwt_expire_hours: int = 168  # 7 days
+    token_cache_size: int = 10_000
 
     # Redis (optional)
     redis_url: str = ""
 
     # DB
     db_path: str = "data/ragbot.db"
+    db_pool_min_size: int = 1
+    db_pool_max_size: int = 4
+    parent_cache_users: int = 16  # users whose parent paragraphs are held in RAM
 
     # Limits
     max_upload_mb: int = 10
@@ -0,0 +1,186 @@
+"""
+Persisted sparse BM25 index.
+
+Term frequencies are stored term-major as CSC-style arrays (indptr / doc ids / tf) next
+to the corpus in bm25_index.mpk, so a corpus is tokenized once: uploads tokenize only
+their own chunks and merge them into the stored counts. Okapi weights depend on
+corpus-wide statistics, so they are recomputed per term/doc pair with NumPy at load
+time; a query then sums one precomputed column slice per term.
+
+Scoring matches rank_bm25.BM25Okapi (k1=1.5, b=0.75, idf floored at eps * mean idf)
+with the same whitespace tokenizer as LangChain's BM25Retriever, so rankings are
+unchanged.
+"""
+import os
+from typing import Any, Callable, Dict, List, Optional
+
+import msgpack
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+K1 = 1.5
+B = 0.75
+EPSILON = 0.25
+
+
+def tokenize(text: str) -> List[str]:
+    return text.split()
+
+
+class BM25Index:
+    def __init__(
+        self,
+        vocab: List[str],
+        indptr: np.ndarray,
+        doc_ids: np.ndarray,
+        tf: np.ndarray,
+        doc_len: np.ndarray,
+    ) -> None:
+        self.vocab = vocab
+        self.term_ids: Dict[str, int] = {t: i for i, t in enumerate(vocab)}
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tf = tf
+        self.doc_len = doc_len
+        self.weights = self._weights()
+
+    @property
+    def n_docs(self) -> int:
+        return len(self.doc_len)
+
+    def _weights(self) -> np.ndarray:
+        if not self.n_docs or not self.vocab:
+            return np.zeros(0, dtype=np.float32)
+        df = np.diff(self.indptr)
+        idf = np.log(self.n_docs - df + 0.5) - np.log(df + 0.5)
+        idf[idf < 0] = EPSILON * idf.mean()
+        tf = self.tf.astype(np.float64)
+        norm = K1 * (1 - B + B * self.doc_len[self.doc_ids] / self.doc_len.mean())
+        return (np.repeat(idf, df) * tf * (K1 + 1) / (tf + norm)).astype(np.float32)
+
+    def scores(self, query: str) -> np.ndarray:
+        out = np.zeros(self.n_docs, dtype=np.float32)
+        for token in tokenize(query):
+            t = self.term_ids.get(token)
+            if t is None:
+                continue
+            lo, hi = self.indptr[t], self.indptr[t + 1]
+            out[self.doc_ids[lo:hi]] += self.weights[lo:hi]
+        return out
+
+    def extend(self, texts: List[str]) -> "BM25Index":
+        """Index with `texts` appended as new documents; only the new texts are tokenized."""
+        vocab = list(self.vocab)
+        term_ids = dict(self.term_ids)
+        new_terms: List[int] = []
+        new_docs: List[int] = []
+        lengths: List[int] = []
+        for offset, text in enumerate(texts):
+            tokens = tokenize(text)
+            lengths.append(len(tokens))
+            for token in tokens:
+                t = term_ids.get(token)
+                if t is None:
+                    t = term_ids[token] = len(vocab)
+                    vocab.append(token)
+                new_terms.append(t)
+            new_docs.extend([self.n_docs + offset] * len(tokens))
+
+        n_docs = self.n_docs + len(texts)
+        old_terms = np.repeat(np.arange(len(self.vocab), dtype=np.int64), np.diff(self.indptr))
+        keys = np.concatenate([
+            old_terms * n_docs + self.doc_ids,
+            np.asarray(new_terms, dtype=np.int64) * n_docs + np.asarray(new_docs, dtype=np.int64),
+        ])
+        counts = np.concatenate([self.tf, np.ones(len(new_terms), dtype=np.int32)])
+        uniq, inverse = np.unique(keys, return_inverse=True)
+        tf = np.bincount(inverse, weights=counts).astype(np.int32)
+        terms = uniq // n_docs
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(terms, minlength=len(vocab)), out=indptr[1:])
+        doc_len = np.concatenate([self.doc_len, np.asarray(lengths, dtype=np.int32)])
+        return BM25Index(vocab, indptr, uniq % n_docs, tf, doc_len)
+
+    def remove(self, keep: np.ndarray) -> "BM25Index":
+        """Index over the documents where `keep` is True, renumbered in order; no re-tokenizing."""
+        keep_nnz = keep[self.doc_ids]
+        renumber = np.cumsum(keep) - 1
+        terms = np.repeat(np.arange(len(self.vocab), dtype=np.int64), np.diff(self.indptr))[keep_nnz]
+        # Drop terms left without postings so the mean idf (epsilon floor) matches a fresh build.
+        df = np.bincount(terms, minlength=len(self.vocab))
+        live = df > 0
+        indptr = np.zeros(int(live.sum()) + 1, dtype=np.int64)
+        np.cumsum(df[live], out=indptr[1:])
+        vocab = [t for t, alive in zip(self.vocab, live.tolist()) if alive]
+        return BM25Index(vocab, indptr, renumber[self.doc_ids[keep_nnz]], self.tf[keep_nnz], self.doc_len[keep])
+
+    @classmethod
+    def empty(cls) -> "BM25Index":
+        return cls([], np.zeros(1, dtype=np.int64), np.zeros(0, dtype=np.int64),
+                   np.zeros(0, dtype=np.int32), np.zeros(0, dtype=np.int32))
+
+    @classmethod
+    def build(cls, texts: List[str]) -> "BM25Index":
+        return cls.empty().extend(texts)
+
+
+def save_index(index: BM25Index, path: str) -> None:
+    payload = {
+        "v": index.vocab,
+        "p": index.indptr.astype("<i8").tobytes(),
+        "d": index.doc_ids.astype("<i8").tobytes(),
+        "f": index.tf.astype("<i4").tobytes(),
+        "l": index.doc_len.astype("<i4").tobytes(),
+    }
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(msgpack.packb(payload))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+def load_index(path: str) -> Optional[BM25Index]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "rb") as f:
+        payload = msgpack.unpackb(f.read(), raw=False)
+    return BM25Index(
+        payload["v"],
+        np.frombuffer(payload["p"], dtype="<i8"),
+        np.frombuffer(payload["d"], dtype="<i8"),
+        np.frombuffer(payload["f"], dtype="<i4"),
+        np.frombuffer(payload["l"], dtype="<i4"),
+    )
+
+
+class SparseBM25Retriever(BaseRetriever):
+    """BM25Retriever replacement that scores against a prebuilt BM25Index."""
+    docs: List[Document]
+    index: Any
+    k: int = 4
+    filter: Optional[Callable[[dict], bool]] = None  # metadata predicate, checked best-first
+
+    def _get_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: Optional[CallbackManagerForRetrieverRun] = None,
+    ) -> List[Document]:
+        if not self.docs:
+            return []
+        scores = self.index.scores(query)
+        if self.filter is not None:
+            hits: List[Document] = []
+            for i in np.argsort(-scores, kind="stable").tolist():
+                if self.filter(self.docs[i].metadata):
+                    hits.append(self.docs[i])
+                    if len(hits) == self.k:
+                        break
+            return hits
+        k = min(self.k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="stable")]
+        return [self.docs[i] for i in top]
@@ -1,51 +1,88 @@
 import hashlib
-import json
-from typing import Any, List, Optional
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, Hashable, List, NamedTuple, Optional, Sequence, Set, Tuple
+
+import numpy as np
+import orjson
 
 from app.config import settings
 
 
+def _connect_redis():
+    """One client (and connection pool) shared by every cache in the process."""
+    if not settings.redis_url:
+        return None
+    try:
+        import redis.asyncio as redis
+        return redis.Redis.from_url(settings.redis_url, max_connections=32)
+    except Exception:
+        return None
+
+
+_redis = _connect_redis()
+
+
+def _embedding_key(text: str) -> str:
+    # Values are raw little-endian float32; the f32 segment keeps old JSON entries from being misread.
+    return f"emb:f32:{hashlib.sha256(text.encode()).hexdigest()}"
+
+
+def _pack_vector(embedding: Sequence[float]) -> bytes:
+    return np.asarray(embedding, dtype="<f4").tobytes()
+
+
+def _unpack_vector(val: bytes) -> np.ndarray:
+    return np.frombuffer(val, dtype="<f4")
+
+
 class EmbeddingCache:
     def __init__(self) -> None:
-        self.redis = None
-        if settings.redis_url:
-            try:
-                import redis.asyncio as redis
-                self.redis = redis.from_url(settings.redis_url)
-            except Exception:
-                pass
-
-    async def get(self, text: str) -> Optional[List[float]]:
+        self.redis = _redis
+
+    async def get(self, text: str) -> Optional[np.ndarray]:
         if not self.redis:
             return None
         try:
-            key = f"emb:{hashlib.sha256(text.encode()).hexdigest()}"
-            val = await self.redis.get(key)
+            val = await self.redis.get(_embedding_key(text))
             if val:
-                return json.loads(val)
+                return _unpack_vector(val)
         except Exception:
             pass
         return None
 
-    async def set(self, text: str, embedding: List[float]) -> None:
+    async def mget(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        """Look up many embeddings in one round-trip; misses come back as None."""
+        if not self.redis or not texts:
+            return [None] * len(texts)
+        try:
+            vals = await self.redis.mget([_embedding_key(t) for t in texts])
+            return [_unpack_vector(v) if v else None for v in vals]
+        except Exception:
+            return [None] * len(texts)
+
+    async def set(self, text: str, embedding: Sequence[float]) -> None:
         if not self.redis:
             return
         try:
-            key = f"emb:{hashlib.sha256(text.encode()).hexdigest()}"
-            await self.redis.setex(key, 86400, json.dumps(embedding))
+            await self.redis.setex(_embedding_key(text), 86400, _pack_vector(embedding))
+        except Exception:
+            pass
+
+    async def mset(self, texts: List[str], embeddings: Sequence[Sequence[float]]) -> None:
+        if not self.redis or not texts:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for text, embedding in zip(texts, embeddings):
+                pipe.setex(_embedding_key(text), 86400, _pack_vector(embedding))
+            await pipe.execute()
         except Exception:
             pass
 
 
 class QueryCache:
     def __init__(self) -> None:
-        self.redis = None
-        if settings.redis_url:
-            try:
-                import redis.asyncio as redis
-                self.redis = redis.from_url(settings.redis_url)
-            except Exception:
-                pass
+        self.redis = _redis
 
     async def get(self, user_id: str, query: str) -> Optional[dict]:
         if not self.redis:
@@ -55,7 +92,7 @@ class QueryCache:
             key = f"qry:{user_id}:{hashlib.sha256(q.encode()).hexdigest()}"
             val = await self.redis.get(key)
             if val:
-                return json.loads(val)
+                return orjson.loads(val)
         except Exception:
             pass
         return None
@@ -66,7 +103,12 @@ class QueryCache:
         try:
             q = query.lower().strip()
             key = f"qry:{user_id}:{hashlib.sha256(q.encode()).hexdigest()}"
-            await self.redis.setex(key, 3600, json.dumps(data))
+            index_key = f"qidx:{user_id}"
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.setex(key, 3600, orjson.dumps(data))
+            pipe.sadd(index_key, key)
+            pipe.expire(index_key, 3600)
+            await pipe.execute()
         except Exception:
             pass
 
@@ -74,12 +116,121 @@ class QueryCache:
         if not self.redis:
             return
         try:
-            pattern = f"qry:{user_id}:*"
-            async for key in self.redis.scan_iter(match=pattern):
-                await self.redis.delete(key)
+            index_key = f"qidx:{user_id}"
+            keys = await self.redis.smembers(index_key)
+            pipe = self.redis.pipeline(transaction=False)
+            if keys:
+                pipe.delete(*keys)
+            pipe.delete(index_key)
+            await pipe.execute()
         except Exception:
             pass
 
 
+class _SemanticEntry(NamedTuple):
+    user_id: str
+    stamp: Hashable
+    vec: np.ndarray
+    chunk_ids: FrozenSet
+    codes: Tuple[int, ...]
+    value: dict
+
+
+class SemanticCache:
+    """In-process answer cache that also matches paraphrases, not just identical queries.
+
+    Query embeddings are bucketed with random-projection LSH (n_tables tables of n_bits
+    hyperplanes each). A candidate from a shared bucket is only reused when it was
+    answered against the same index stamp, its embedding is within `similarity`
+    cosine, and the chunks retrieved now overlap the ones it was answered from by at
+    least `overlap` (Jaccard) -- so the cached answer is grounded in the same context.
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 2048,
+        n_tables: int = 8,
+        n_bits: int = 12,
+        similarity: float = 0.95,
+        overlap: float = 0.8,
+    ) -> None:
+        self.maxsize = maxsize
+        self.n_tables = n_tables
+        self.n_bits = n_bits
+        self.similarity = similarity
+        self.overlap = overlap
+        self._planes: Optional[np.ndarray] = None
+        self._weights = 1 << np.arange(n_bits)
+        self._entries: "OrderedDict[int, _SemanticEntry]" = OrderedDict()
+        self._buckets: Dict[Tuple[str, int, int], Set[int]] = {}
+        self._next_id = 0
+
+    def _codes(self, vec: np.ndarray) -> Tuple[int, ...]:
+        if self._planes is None or self._planes.shape[-1] != vec.shape[0]:
+            rng = np.random.default_rng(0)
+            self._planes = rng.standard_normal((self.n_tables, self.n_bits, vec.shape[0])).astype(np.float32)
+            self._entries.clear()
+            self._buckets.clear()
+        bits = (self._planes @ vec) > 0
+        return tuple((bits * self._weights).sum(axis=1).tolist())
+
+    @staticmethod
+    def _normalise(vec: Sequence[float]) -> np.ndarray:
+        arr = np.asarray(vec, dtype=np.float32)
+        norm = float(np.linalg.norm(arr))
+        return arr / norm if norm else arr
+
+    def lookup(self, user_id: str, stamp: Hashable, vec: Sequence[float], chunk_ids: FrozenSet) -> Optional[dict]:
+        q = self._normalise(vec)
+        candidates: Set[int] = set()
+        for table, code in enumerate(self._codes(q)):
+            candidates |= self._buckets.get((user_id, table, code), set())
+        ids = [i for i in candidates if self._entries[i].stamp == stamp]
+        if not ids:
+            return None
+        # One BLAS matvec scores every candidate; the Jaccard gate then walks them best-first.
+        sims = np.stack([self._entries[i].vec for i in ids]) @ q
+        for pos in np.argsort(-sims, kind="stable").tolist():
+            if sims[pos] < self.similarity:
+                break
+            entry = self._entries[ids[pos]]
+            union = len(entry.chunk_ids | chunk_ids)
+            if union and len(entry.chunk_ids & chunk_ids) / union < self.overlap:
+                continue
+            self._entries.move_to_end(ids[pos])
+            return entry.value
+        return None
+
+    def store(self, user_id: str, stamp: Hashable, vec: Sequence[float], chunk_ids: FrozenSet, value: dict) -> None:
+        q = self._normalise(vec)
+        codes = self._codes(q)
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = _SemanticEntry(user_id, stamp, q, chunk_ids, codes, value)
+        for table, code in enumerate(codes):
+            self._buckets.setdefault((user_id, table, code), set()).add(entry_id)
+        while len(self._entries) > self.maxsize:
+            self._evict(next(iter(self._entries)))
+
+    def _evict(self, entry_id: int) -> None:
+        entry = self._entries.pop(entry_id)
+        for table, code in enumerate(entry.codes):
+            key = (entry.user_id, table, code)
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                bucket.discard(entry_id)
+                if not bucket:
+                    del self._buckets[key]
+
+    def invalidate_user(self, user_id: str) -> None:
+        for entry_id in [i for i, e in self._entries.items() if e.user_id == user_id]:
+            self._evict(entry_id)
+
+
 embedding_cache = EmbeddingCache()
 query_cache = QueryCache()
+semantic_cache = SemanticCache(
+    maxsize=settings.semantic_cache_size,
+    similarity=settings.semantic_cache_similarity,
+    overlap=settings.semantic_cache_overlap,
+)
@@ -0,0 +1,73 @@
+"""
+Batched document embeddings against Ollama's /api/embed endpoint.
+
+Ingest splits its chunks into fixed-size batches and sends them concurrently on one
+shared httpx client, bounded by a semaphore, instead of a single blocking
+embed_documents call per upload. Query-time embedding still goes through the
+LangChain embeddings object attached to the FAISS store.
+"""
+import asyncio
+from typing import List, Optional
+
+import httpx
+import numpy as np
+
+from app.config import settings
+
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+_client: Optional[httpx.AsyncClient] = None
+_semaphore = asyncio.Semaphore(settings.embed_concurrency)
+
+
+def _get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            base_url=settings.ollama_base_url,
+            timeout=httpx.Timeout(120.0, connect=5.0),
+            http2=_HTTP2,
+        )
+    return _client
+
+
+async def close_client() -> None:
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _embed_one(batch: List[str]) -> List[List[float]]:
+    async with _semaphore:
+        resp = await _get_client().post(
+            "/api/embed", json={"model": settings.ollama_embed_model, "input": batch}
+        )
+    resp.raise_for_status()
+    return resp.json()["embeddings"]
+
+
+async def preload_models() -> None:
+    """Have Ollama load the embed and chat models now rather than on the first request."""
+    client = _get_client()
+    await asyncio.gather(
+        client.post("/api/embed", json={"model": settings.ollama_embed_model, "input": ["warmup"]}),
+        # A generate call without a prompt only loads the model.
+        client.post("/api/generate", json={"model": settings.ollama_chat_model}),
+    )
+
+
+async def embed_batch(texts: List[str]) -> np.ndarray:
+    """Embed texts as an (n, dim) float32 array, preserving input order."""
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    if settings.sanity_mock:
+        from langchain_community.embeddings import FakeEmbeddings
+        return np.asarray(FakeEmbeddings(size=768).embed_documents(texts), dtype=np.float32)
+    size = settings.embed_batch_size
+    results = await asyncio.gather(*(_embed_one(texts[i:i + size]) for i in range(0, len(texts), size)))
+    return np.asarray([vec for batch in results for vec in batch], dtype=np.float32)
@@ -1,9 +1,15 @@
 import asyncio
+import logging
 import os
 import pickle
-from typing import Any, Dict, List, Optional
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
+import httpx
+import msgpack
 import networkx as nx
+import numpy as np
 from langchain_ollama import ChatOllama
 from langchain_core.documents import Document
 from langchain_core.output_parsers import JsonOutputParser
@@ -11,17 +17,23 @@ from langchain_core.prompts import PromptTemplate
 
 from app.config import settings
 
+logger = logging.getLogger(__name__)
+
+_RETRYABLE = (ConnectionError, TimeoutError, httpx.TransportError)
+# Bounds an upload's per-chunk fan-out only; query-time extraction must not queue behind it.
+_ingest_semaphore = asyncio.Semaphore(settings.graph_llm_concurrency)
+
 GRAPH_EXTRACT_PROMPT = """Extract entities and relationships from the text below.
 Return ONLY valid JSON. No text outside the JSON.
 
-{
+{{
   "entities": [
-    {"id": "lowercase_id", "label": "Display Name", "type": "person|org|concept|term"}
+    {{"id": "lowercase_id", "label": "Display Name", "type": "person|org|concept|term"}}
   ],
   "relationships": [
-    {"source": "entity_id", "target": "entity_id", "relation": "short_verb_phrase"}
+    {{"source": "entity_id", "target": "entity_id", "relation": "short_verb_phrase"}}
   ]
-}
+}}
 
 Rules:
 - Extract 3-10 entities maximum per chunk. Quality over quantity.
@@ -44,20 +56,37 @@ def _get_graph_llm():
     )
 
 
-async def extract_graph_data(text: str, doc_source: str) -> dict:
+@lru_cache(maxsize=2)
+def _extract_chain(mock: bool):
     llm = _get_graph_llm()
     if not llm:
-        return {"entities": [], "relationships": []}
+        return None
     prompt = PromptTemplate(template=GRAPH_EXTRACT_PROMPT, input_variables=["text"])
-    chain = prompt | llm | JsonOutputParser()
-    try:
-        result = await asyncio.to_thread(
-            chain.invoke,
-            {"text": (text or "")[:2000]},
-        )
-        return result
-    except Exception:
+    return prompt | llm | JsonOutputParser()
+
+
+async def extract_graph_data(
+    text: str, doc_source: str, semaphore: Optional[asyncio.Semaphore] = None
+) -> dict:
+    chain = _extract_chain(settings.sanity_mock)
+    if chain is None:
         return {"entities": [], "relationships": []}
+    payload = {"text": (text or "")[:2000]}
+    for attempt in range(settings.graph_llm_retries + 1):
+        try:
+            if semaphore is None:
+                return await asyncio.to_thread(chain.invoke, payload)
+            async with semaphore:
+                return await asyncio.to_thread(chain.invoke, payload)
+        except _RETRYABLE as e:
+            if attempt == settings.graph_llm_retries:
+                logger.warning("Graph extraction failed for %s: %s", doc_source, e)
+                break
+            await asyncio.sleep(0.5 * 2 ** attempt)
+        except Exception as e:
+            logger.debug("Graph extraction returned unusable output for %s: %s", doc_source, e)
+            break
+    return {"entities": [], "relationships": []}
 
 
 async def update_user_graph(
@@ -68,20 +97,26 @@ async def update_user_graph(
     """Extract entities from all parent chunks and build/update user's graph."""
     if graph_store is None:
         graph_store = _get_graph_store()
-    G = graph_store.get(user_id, nx.Graph())
+    G = await aget_graph(graph_store, user_id)
+    if G is None:
+        G = nx.Graph()
 
     parent_chunks = [c for c in chunks if c.metadata.get("type") == "parent"]
     if not parent_chunks:
         return
 
+    touched_nodes: set = set()
+    touched_edges: set = set()
+
     tasks = [
-        extract_graph_data(chunk.page_content, chunk.metadata.get("source", "unknown"))
+        extract_graph_data(chunk.page_content, chunk.metadata.get("source", "unknown"), _ingest_semaphore)
         for chunk in parent_chunks
     ]
     results = await asyncio.gather(*tasks, return_exceptions=True)
 
     for chunk, result in zip(parent_chunks, results):
         if isinstance(result, Exception):
+            logger.warning("Graph extraction task failed: %s", result)
             continue
         for entity in result.get("entities", []):
             node_id = str(entity.get("id", "")).strip()
@@ -98,6 +133,7 @@ async def update_user_graph(
                 G.nodes[node_id]["doc_sources"].append(doc_src)
             else:
                 G.add_node(node_id, label=label, type=etype, doc_sources=[doc_src])
+            touched_nodes.add(node_id)
 
         for rel in result.get("relationships", []):
             src = str(rel.get("source", "")).strip()
@@ -111,19 +147,271 @@ async def update_user_graph(
                 G[src][tgt]["weight"] = G[src][tgt].get("weight", 1) + 1.0
             else:
                 G.add_edge(src, tgt, relation=rel.get("relation", "related_to"), weight=1.0, doc_source=doc_src)
+            touched_edges.add((src, tgt))
 
     graph_store[user_id] = G
-    graph_path = f"vectorstore/user_{user_id}/knowledge_graph.pkl"
-    os.makedirs(os.path.dirname(graph_path), exist_ok=True)
+    _drop_derived(user_id)
+    deltas = [("n", n, dict(G.nodes[n])) for n in touched_nodes]
+    deltas += [("e", u, v, dict(G[u][v])) for u, v in touched_edges]
+    if deltas:
+        await asyncio.to_thread(_append_graph_delta, user_id, G, deltas)
+
+
+def _graph_paths(user_id: str) -> Tuple[str, str]:
+    base = f"vectorstore/user_{user_id}"
+    return os.path.join(base, "knowledge_graph.mpk"), os.path.join(base, "graph.log")
+
+
+def _legacy_graph_path(user_id: str) -> str:
+    return os.path.join(f"vectorstore/user_{user_id}", "knowledge_graph.pkl")
+
+
+def _dump_graph(G: nx.Graph) -> bytes:
+    """Flat node/edge arrays instead of networkx's nested adjacency dicts."""
+    return msgpack.packb({
+        "n": [(n, attrs) for n, attrs in G.nodes(data=True)],
+        "e": [(u, v, attrs) for u, v, attrs in G.edges(data=True)],
+    })
+
+
+def _load_graph(data: bytes) -> nx.Graph:
+    payload = msgpack.unpackb(data, raw=False)
+    G = nx.Graph()
+    G.add_nodes_from(payload["n"])
+    G.add_edges_from(payload["e"])
+    return G
+
+
+def _append_graph_delta(user_id: str, G: nx.Graph, deltas: List[tuple]) -> None:
+    """Append node/edge state records; fold them into a full checkpoint every N records."""
+    checkpoint_path, log_path = _graph_paths(user_id)
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    with open(log_path, "ab") as f:
+        f.write(b"".join(msgpack.packb(d) for d in deltas))
+    _pending_deltas[user_id] = _pending_deltas.get(user_id, 0) + len(deltas)
+    if _pending_deltas[user_id] >= settings.graph_checkpoint_every:
+        checkpoint_graph(user_id, G)
+
+
+def checkpoint_graph(user_id: str, G: nx.Graph) -> None:
+    checkpoint_path, log_path = _graph_paths(user_id)
+    os.makedirs(os.path.dirname(checkpoint_path), exist_ok=True)
+    tmp = checkpoint_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(_dump_graph(G))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, checkpoint_path)
+    for stale in (log_path, _legacy_graph_path(user_id)):
+        if os.path.exists(stale):
+            os.remove(stale)
+    _pending_deltas[user_id] = 0
+
+
+def load_user_graph(user_id: str) -> Optional[nx.Graph]:
+    """Last checkpoint plus a replay of the delta log written since."""
+    checkpoint_path, log_path = _graph_paths(user_id)
+    legacy_path = _legacy_graph_path(user_id)
+    if not any(os.path.exists(p) for p in (checkpoint_path, log_path, legacy_path)):
+        return None
+    G = nx.Graph()
+    if os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "rb") as f:
+            G = _load_graph(f.read())
+    elif os.path.exists(legacy_path):
+        with open(legacy_path, "rb") as f:
+            G = pickle.load(f)
+    replayed = 0
+    if os.path.exists(log_path):
+        with open(log_path, "rb") as f:
+            for rec in msgpack.Unpacker(f, raw=False):
+                if rec[0] == "n":
+                    G.add_node(rec[1], **rec[2])
+                elif rec[0] == "e":
+                    G.add_edge(rec[1], rec[2], **rec[3])
+                replayed += 1
+    _pending_deltas[user_id] = replayed
+    return G
+
+
+class GraphStore(OrderedDict):
+    """user_id -> nx.Graph, loaded from disk on first access and LRU-bounded.
+
+    Startup no longer reads every user's graph. A lookup for a user that isn't resident
+    loads their checkpoint + delta log; past `maxsize` users the least recently used
+    graph is dropped. Every update is already in the delta log, so an evicted graph
+    reloads intact. Async callers should `await aload(user_id)` first so that read runs
+    off the event loop; plain lookups then only fall back to a blocking load.
+    """
+
+    def __init__(self, maxsize: int = 64) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+        self._absent: set = set()
+
+    def __missing__(self, user_id: str) -> nx.Graph:
+        if user_id in self._absent:
+            raise KeyError(user_id)
+        try:
+            G = load_user_graph(user_id)
+        except Exception as e:
+            logger.warning("Knowledge graph for %s not loaded: %s", user_id, e)
+            G = None
+        if G is None:
+            self._absent.add(user_id)
+            raise KeyError(user_id)
+        self[user_id] = G
+        return G
+
+    def __getitem__(self, user_id: str) -> nx.Graph:
+        G = super().__getitem__(user_id)
+        self.move_to_end(user_id)
+        return G
+
+    def __setitem__(self, user_id: str, G: nx.Graph) -> None:
+        super().__setitem__(user_id, G)
+        self.move_to_end(user_id)
+        self._absent.discard(user_id)
+        while len(self) > self.maxsize:
+            evicted, _ = self.popitem(last=False)
+            _drop_derived(evicted)
+
+    def get(self, user_id: str, default: Any = None) -> Any:
+        try:
+            return self[user_id]
+        except KeyError:
+            return default
+
+    async def aload(self, user_id: str) -> Optional[nx.Graph]:
+        if user_id in self or user_id in self._absent:
+            return self.get(user_id)
+        return await asyncio.to_thread(self.get, user_id)
+
+
+async def aget_graph(graph_store: Dict[str, nx.Graph], user_id: str) -> Optional[nx.Graph]:
+    """graph_store.get(user_id), with any disk read done in a worker thread."""
+    if isinstance(graph_store, GraphStore):
+        return await graph_store.aload(user_id)
+    return graph_store.get(user_id)
+
+
+def load_graph_store() -> "GraphStore":
+    """The process-wide graph store; graphs are read lazily, so this does no I/O."""
+    return _graph_store
 
-    def _dump():
-        with open(graph_path, "wb") as f:
-            pickle.dump(G, f)
 
-    await asyncio.to_thread(_dump)
+def checkpoint_pending(graph_store: Dict[str, nx.Graph]) -> None:
+    for user_id, G in list(graph_store.items()):
+        if _pending_deltas.get(user_id):
+            checkpoint_graph(user_id, G)
+
+
+_graph_store = GraphStore(maxsize=settings.graph_cache_users)
+_pending_deltas: Dict[str, int] = {}
+_trigram_index: Dict[str, Tuple[int, int, Dict[str, set], List[str]]] = {}
+_neighbor_cache: Dict[str, Tuple[int, int, Dict[str, Tuple[List[str], np.ndarray]]]] = {}
+_snapshots: Dict[str, Tuple[Tuple[int, int, int], "GraphSnapshot"]] = {}
+
+
+def _drop_derived(user_id: str) -> None:
+    """Forget the lookup structures built from a user's graph (it changed or was evicted)."""
+    _trigram_index.pop(user_id, None)
+    _neighbor_cache.pop(user_id, None)
+    _snapshots.pop(user_id, None)
+
+
+def _trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _get_trigram_index(user_id: str, G: nx.Graph) -> Tuple[Dict[str, set], List[str]]:
+    """Trigram -> node ids, plus the ids too short to have a trigram. Rebuilt when G changes."""
+    cached = _trigram_index.get(user_id)
+    if cached and cached[0] == id(G) and cached[1] == G.number_of_nodes():
+        return cached[2], cached[3]
+    index: Dict[str, set] = {}
+    short: List[str] = []
+    for node in G.nodes:
+        grams = _trigrams(node)
+        if not grams:
+            short.append(node)
+        for gram in grams:
+            index.setdefault(gram, set()).add(node)
+    _trigram_index[user_id] = (id(G), G.number_of_nodes(), index, short)
+    return index, short
+
+
+def _get_neighbor_cache(user_id: str, G: nx.Graph) -> Dict[str, Tuple[List[str], np.ndarray]]:
+    cached = _neighbor_cache.get(user_id)
+    if cached and cached[0] == id(G) and cached[1] == G.number_of_edges():
+        return cached[2]
+    nbr_cache: Dict[str, Tuple[List[str], np.ndarray]] = {}
+    _neighbor_cache[user_id] = (id(G), G.number_of_edges(), nbr_cache)
+    return nbr_cache
+
+
+def _top_neighbors(G: nx.Graph, node: str, nbr_cache: dict, k: int = 3) -> List[str]:
+    """The k heaviest edges out of `node`; neighbour/weight arrays are built once per node."""
+    entry = nbr_cache.get(node)
+    if entry is None:
+        nbrs = list(G.neighbors(node))
+        weights = np.fromiter((G[node][n].get("weight", 1) for n in nbrs), dtype=np.float32, count=len(nbrs))
+        entry = nbr_cache[node] = (nbrs, weights)
+    nbrs, weights = entry
+    if len(nbrs) <= k:
+        return nbrs
+    return [nbrs[i] for i in np.argpartition(-weights, k)[:k]]
+
+
+class GraphSnapshot(NamedTuple):
+    nodes: List[dict]  # graph order
+    edges: List[dict]
+    entities: List[dict]  # by degree, descending; ties keep graph order
+
+
+def graph_snapshot(user_id: str, G: nx.Graph) -> GraphSnapshot:
+    """JSON-ready views of G for the /graph endpoints, rebuilt only after the graph changes."""
+    key = (id(G), G.number_of_nodes(), G.number_of_edges())
+    cached = _snapshots.get(user_id)
+    if cached and cached[0] == key:
+        return cached[1]
+    ids = list(G.nodes)
+    degrees = np.fromiter((d for _, d in G.degree(ids)), dtype=np.int64, count=len(ids))
+    node_data = G.nodes
+    nodes = [
+        {"id": n, "label": node_data[n].get("label", n), "type": node_data[n].get("type", "concept"), "degree": d}
+        for n, d in zip(ids, degrees.tolist())
+    ]
+    entities = [
+        {**nodes[i], "doc_sources": list(set(node_data[ids[i]].get("doc_sources", [])))}
+        for i in np.argsort(-degrees, kind="stable").tolist()
+    ]
+    # nx.Graph is undirected and yields each edge once, so no (u, v) / (v, u) dedup.
+    edges = [
+        {"source": u, "target": v, "relation": d.get("relation", "related_to"), "weight": d.get("weight", 1)}
+        for u, v, d in G.edges(data=True)
+    ]
+    snapshot = GraphSnapshot(nodes, edges, entities)
+    _snapshots[user_id] = (key, snapshot)
+    return snapshot
 
 
-_graph_store: Dict[str, nx.Graph] = {}
+def _match_nodes(query_ids: set, G: nx.Graph, user_id: str) -> set:
+    """Nodes whose id contains, or is contained in, a query entity id."""
+    index, short = _get_trigram_index(user_id, G)
+    matched = set()
+    for qe in query_ids:
+        if not qe:
+            continue
+        grams = _trigrams(qe)
+        if grams:
+            candidates = set(short)
+            for gram in grams:
+                candidates.update(index.get(gram, ()))
+        else:
+            candidates = G.nodes
+        matched.update(n for n in candidates if qe in n or n in qe)
+    return matched
 
 
 def _get_graph_store() -> Dict[str, nx.Graph]:
@@ -149,29 +437,18 @@ async def get_graph_context(
     query_data = await extract_graph_data(query, "query")
     query_entity_ids = {str(e.get("id", "")).strip() for e in query_data.get("entities", []) if e.get("id")}
 
-    matched_nodes = set()
-    for qe in query_entity_ids:
-        if not qe:
-            continue
-        for node in G.nodes:
-            if qe in node or node in qe:
-                matched_nodes.add(node)
+    matched_nodes = _match_nodes(query_entity_ids, G, user_id)
 
     if not matched_nodes:
         return ""
 
+    nbr_cache = _get_neighbor_cache(user_id, G)
     subgraph_nodes = set(matched_nodes)
     frontier = set(matched_nodes)
     for _ in range(max_hops):
         next_frontier = set()
         for node in frontier:
-            neighbors = list(G.neighbors(node))
-            ranked = sorted(
-                neighbors,
-                key=lambda n: G[node][n].get("weight", 1),
-                reverse=True,
-            )[:3]
-            next_frontier.update(ranked)
+            next_frontier.update(_top_neighbors(G, node, nbr_cache))
         subgraph_nodes.update(next_frontier)
         frontier = next_frontier
         if len(subgraph_nodes) >= max_nodes:
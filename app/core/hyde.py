@@ -0,0 +1,78 @@
+"""
+Memoised HyDE query embeddings.
+
+Generating the hypothetical document is an LLM round-trip, so embeddings are cached
+on the normalised query (lowercased, punctuation stripped, whitespace collapsed) in an
+in-process LRU. Entries are also appended to a msgpack log so the cache survives
+restarts; the log is compacted on load once it holds twice the LRU size. Queries
+longer than HYDE_MAX_QUERY_TOKENS are already specific and skip HyDE entirely.
+"""
+import hashlib
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, List
+
+import msgpack
+import numpy as np
+
+from app.config import settings
+
+_PUNCT_RE = re.compile(r"[^\w\s]")
+
+
+def _cache_key(query: str) -> bytes:
+    normalised = " ".join(_PUNCT_RE.sub("", query.lower()).split())
+    return hashlib.blake2b(normalised.encode(), digest_size=16).digest()
+
+
+class CachedHyDEEmbeddings:
+    def __init__(self, hyde: Any, base: Any, path: str, maxsize: int = 1024) -> None:
+        self.hyde = hyde
+        self.base = base
+        self.path = path
+        self.maxsize = maxsize
+        self._lru: "OrderedDict[bytes, List[float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        records = 0
+        with open(self.path, "rb") as f:
+            for key, vec in msgpack.Unpacker(f, raw=True):
+                self._lru[key] = np.frombuffer(vec, dtype="<f4").tolist()
+                self._lru.move_to_end(key)
+                records += 1
+        while len(self._lru) > self.maxsize:
+            self._lru.popitem(last=False)
+        if records > 2 * self.maxsize:
+            tmp = self.path + ".tmp"
+            with open(tmp, "wb") as f:
+                f.write(b"".join(self._pack(k, v) for k, v in self._lru.items()))
+            os.replace(tmp, self.path)
+
+    @staticmethod
+    def _pack(key: bytes, vec: List[float]) -> bytes:
+        return msgpack.packb((key, np.asarray(vec, dtype="<f4").tobytes()))
+
+    def embed_query(self, query: str) -> List[float]:
+        if len(query.split()) > settings.hyde_max_query_tokens:
+            return self.base.embed_query(query)
+        key = _cache_key(query)
+        with self._lock:
+            hit = self._lru.get(key)
+            if hit is not None:
+                self._lru.move_to_end(key)
+                return hit
+        vec = self.hyde.embed_query(query)
+        with self._lock:
+            self._lru[key] = vec
+            while len(self._lru) > self.maxsize:
+                self._lru.popitem(last=False)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "ab") as f:
+                f.write(self._pack(key, vec))
+        return vec
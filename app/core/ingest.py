@@ -1,98 +1,134 @@
 import asyncio
 import os
-import pickle
 import re
 import uuid
-from typing import List, Optional, Tuple
+from typing import List, Optional, Tuple, Union
 
 import aiofiles
 import fitz
-import nltk
-from langchain_community.vectorstores import FAISS
+import numpy as np
 from langchain_ollama import OllamaEmbeddings
 from langchain_core.documents import Document
-from nltk.tokenize import sent_tokenize
 
 from app.config import settings
-from app.db import get_db, insert_chunks, insert_document
+from app.core.cache import embedding_cache
+from app.core.embeddings import embed_batch
+from app.core.vectorstore import add_embeddings, append_bm25_corpus, user_dir
+from app.db import get_pool, insert_chunks, insert_document
 
-nltk.download("punkt_tab", quiet=True)
+_SENT_RE = re.compile(r"(?<=[.!?])\s+")
+_HEADING_RE = re.compile(r"^(#{1,4} .+|.+\n[=\-]{3,})", re.MULTILINE)
+_HEADING_RE_B = re.compile(_HEADING_RE.pattern.encode(), re.MULTILINE)
+_HASH_PREFIX_RE = re.compile(r"^#+\s*")
+_INJECTION_RE = re.compile(r"</?system>|</context>|IGNORE PREVIOUS|ignore previous")
 
 
 def _strip_injection(text: str) -> str:
-    for p in ["<system>", "</system>", "</context>", "IGNORE PREVIOUS", "ignore previous"]:
-        text = text.replace(p, "")
-    return text
-
-
-def extract_sections_pdf(path: str) -> List[dict]:
-    doc = fitz.open(path)
-    sections: List[dict] = []
-    current: dict = {"heading": "Introduction", "text": "", "page": 1}
-    body_size: Optional[float] = None
-
+    return _INJECTION_RE.sub("", text)
+
+
+def _heading_mask(texts: List[str], sizes: np.ndarray, body_size: float) -> np.ndarray:
+    """Vectorised heading test: large font, short, title-case, no trailing period."""
+    lens = np.fromiter(map(len, texts), dtype=np.int32, count=len(texts))
+    firsts = np.array([t[0] for t in texts])
+    lasts = np.array([t[-1] for t in texts])
+    return (
+        (sizes >= body_size * 1.2)
+        & (lens < 120)
+        & np.char.isupper(firsts)
+        & (lasts != ".")
+    )
+
+
+def extract_sections_pdf(source: Union[str, bytes]) -> List[dict]:
+    """`source` is a file path or the PDF's bytes."""
+    doc = fitz.open(stream=source, filetype="pdf") if isinstance(source, bytes) else fitz.open(source)
+    texts: List[str] = []
+    sizes: List[float] = []
+    pages: List[int] = []
     for page_num, page in enumerate(doc, 1):
         for block in page.get_text("dict")["blocks"]:
             if block["type"] != 0:
                 continue
             for line in block["lines"]:
                 for span in line["spans"]:
-                    text, size = span["text"].strip(), span["size"]
-                    if not text:
-                        continue
-                    if body_size is None:
-                        body_size = size
-                    is_heading = (
-                        size >= body_size * 1.2
-                        and len(text) < 120
-                        and len(text) > 0
-                        and text[0].isupper()
-                        and not text.endswith(".")
-                    )
-                    if is_heading:
-                        if current["text"].strip():
-                            sections.append(dict(current))
-                        current = {"heading": text, "text": "", "page": page_num}
-                    else:
-                        current["text"] += " " + text
-
-    if current["text"].strip():
-        sections.append(current)
+                    text = span["text"].strip()
+                    if text:
+                        texts.append(text)
+                        sizes.append(span["size"])
+                        pages.append(page_num)
     doc.close()
+
+    sections: List[dict] = []
+    heading, page, parts = "Introduction", 1, []
+
+    def _close() -> None:
+        # Spans are already stripped and non-empty, so any part means a non-blank section.
+        if parts:
+            sections.append({"heading": heading, "text": " ".join(parts), "page": page})
+
+    if texts:
+        size_arr = np.asarray(sizes, dtype=np.float64)
+        is_heading = _heading_mask(texts, size_arr, float(size_arr[0]))
+        for text, page_num, is_head in zip(texts, pages, is_heading.tolist()):
+            if is_head:
+                _close()
+                heading, page, parts = text, page_num, []
+            else:
+                parts.append(text)
+
+    _close()
     return sections
 
 
-def extract_sections_text(text: str) -> List[dict]:
-    pattern = re.compile(r"^(#{1,4} .+|.+\n[=\-]{3,})", re.MULTILINE)
+def _decode(buf: Union[str, bytes]) -> str:
+    return buf if isinstance(buf, str) else buf.decode("utf-8", errors="replace")
+
+
+def extract_sections_text(text: Union[str, bytes]) -> List[dict]:
+    """Split on markdown/setext headings. Accepts raw bytes so only matched spans get decoded."""
+    pattern = _HEADING_RE_B if isinstance(text, bytes) else _HEADING_RE
     positions = [(m.start(), m.group()) for m in pattern.finditer(text)]
     if not positions:
-        return [{"heading": "Document", "text": text, "page": None}]
+        return [{"heading": "Document", "text": _decode(text), "page": None}]
 
     sections = []
     for i, (pos, heading) in enumerate(positions):
         start = pos + len(heading) + 1
         end = positions[i + 1][0] if i + 1 < len(positions) else len(text)
-        clean_heading = re.sub(r"^#+\s*", "", heading.split("\n")[0]).strip()
-        sections.append({"heading": clean_heading, "text": text[start:end].strip(), "page": None})
+        first_line = _decode(heading).split("\n")[0]
+        clean_heading = _HASH_PREFIX_RE.sub("", first_line).strip()
+        sections.append({"heading": clean_heading, "text": _decode(text[start:end]).strip(), "page": None})
     return sections
 
 
+def _split_sentences(text: str) -> List[str]:
+    if settings.use_nltk:
+        import nltk
+        from nltk.tokenize import sent_tokenize
+        nltk.download("punkt_tab", quiet=True)
+        return sent_tokenize(text)
+    return [s for s in _SENT_RE.split(text.strip()) if s]
+
+
 def semantic_chunk(text: str, max_chars: int = 1200, overlap_sentences: int = 2) -> List[str]:
-    sentences = sent_tokenize(text)
+    sentences = _split_sentences(text)
+    n = len(sentences)
+    if not n:
+        return []
+    # cum[i] = total length of sentences[:i]; chunk boundaries come from binary search on it.
+    cum = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.fromiter(map(len, sentences), dtype=np.int64, count=n), out=cum[1:])
+
     chunks: List[str] = []
-    current: List[str] = []
-    current_len = 0
-
-    for sent in sentences:
-        if current_len + len(sent) > max_chars and current:
-            chunks.append(" ".join(current))
-            current = current[-overlap_sentences:]
-            current_len = sum(len(s) for s in current)
-        current.append(sent)
-        current_len += len(sent)
-
-    if current:
-        chunks.append(" ".join(current))
+    start, min_end = 0, 1
+    while True:
+        end = int(np.searchsorted(cum, cum[start] + max_chars, side="right")) - 1
+        end = min(max(end, min_end), n)
+        chunks.append(" ".join(sentences[start:end]))
+        if end >= n:
+            break
+        start, min_end = max(start, end - overlap_sentences), end + 1
     return [c for c in chunks if len(c.strip()) > 50]
 
 
@@ -112,22 +148,27 @@ def _get_mime_type(file_path: str, filename: str) -> str:
     return "text/plain"
 
 
-async def smart_hierarchical_chunk(
-    file_path: str,
+async def _chunk_sections(
+    source: Union[str, bytes],
     mime_type: str,
     doc_id: str,
     filename: str,
-) -> Tuple[List[Document], List[Document]]:
-    """Returns (parents, children). Parents stored in SQLite. Children embedded into FAISS."""
+) -> List[Tuple[Document, List[Document]]]:
+    """Returns one (parent, children) pair per non-empty section, in document order.
+
+    `source` is a file path or the upload's bytes, which are parsed without touching disk.
+    """
     if mime_type == "application/pdf":
-        sections = extract_sections_pdf(file_path)
+        sections = extract_sections_pdf(source)
     else:
-        async with aiofiles.open(file_path, encoding="utf-8", errors="replace") as f:
-            raw = await f.read()
+        if isinstance(source, bytes):
+            raw = source
+        else:
+            async with aiofiles.open(source, "rb") as f:
+                raw = await f.read()
         sections = extract_sections_text(raw)
 
-    parents: List[Document] = []
-    children: List[Document] = []
+    pairs: List[Tuple[Document, List[Document]]] = []
 
     for p_idx, section in enumerate(sections):
         parent_text = _strip_injection(section["text"])
@@ -145,113 +186,112 @@ async def smart_hierarchical_chunk(
                 "type": "parent",
             },
         )
-        parents.append(parent_doc)
 
         child_texts = semantic_chunk(parent_text, max_chars=1200, overlap_sentences=2)
-        for c_idx, child_text in enumerate(child_texts):
-            children.append(
-                Document(
-                    page_content=child_text,
-                    metadata={
-                        "doc_id": doc_id,
-                        "source": filename,
-                        "section": section["heading"],
-                        "page": section.get("page"),
-                        "parent_idx": p_idx,
-                        "child_idx": c_idx,
-                        "type": "child",
-                    },
-                )
+        kids = [
+            Document(
+                page_content=child_text,
+                metadata={
+                    "doc_id": doc_id,
+                    "source": filename,
+                    "section": section["heading"],
+                    "page": section.get("page"),
+                    "parent_idx": p_idx,
+                    "child_idx": c_idx,
+                    "type": "child",
+                },
             )
+            for c_idx, child_text in enumerate(child_texts)
+        ]
+        pairs.append((parent_doc, kids))
+
+    return pairs
 
-    return parents, children
+
+async def smart_hierarchical_chunk(
+    file_path: str,
+    mime_type: str,
+    doc_id: str,
+    filename: str,
+) -> Tuple[List[Document], List[Document]]:
+    """Returns (parents, children). Parents stored in SQLite. Children embedded into FAISS."""
+    pairs = await _chunk_sections(file_path, mime_type, doc_id, filename)
+    return [p for p, _ in pairs], [c for _, kids in pairs for c in kids]
 
 
 async def ingest_document(
     user_id: str,
-    file_path: str,
+    source: Union[str, bytes],
     filename: str,
     progress_callback: Optional[callable] = None,
     graph_store: Optional[dict] = None,
 ) -> dict:
     doc_id = str(uuid.uuid4())
-    mime_type = _get_mime_type(file_path, filename)
+    mime_type = _get_mime_type(source if isinstance(source, str) else "", filename)
 
     if progress_callback:
         await progress_callback("loading", 10)
 
-    parents, children = await smart_hierarchical_chunk(file_path, mime_type, doc_id, filename)
+    sections = await _chunk_sections(source, mime_type, doc_id, filename)
+
+    children: List[Document] = []
+    chunk_records: List[dict] = []
+    for parent_doc, kids in sections:
+        children.extend(kids)
+        for child_doc in kids:
+            chunk_records.append({
+                "id": str(uuid.uuid4()),
+                "doc_id": doc_id,
+                "user_id": user_id,
+                "parent_idx": parent_doc.metadata["parent_idx"],
+                "child_idx": child_doc.metadata["child_idx"],
+                "parent_text": parent_doc.page_content,
+                "child_text": child_doc.page_content,
+                "source": filename,
+                "page": parent_doc.metadata.get("page"),
+                "section": parent_doc.metadata.get("section", ""),
+            })
 
     if not children:
         return {"doc_id": doc_id, "filename": filename, "chunks": 0}
 
-    chunk_records: List[dict] = []
-    parent_by_idx = {p.metadata["parent_idx"]: p for p in parents}
-    for child_doc in children:
-        p_idx = child_doc.metadata["parent_idx"]
-        c_idx = child_doc.metadata["child_idx"]
-        parent_doc = parent_by_idx.get(p_idx)
-        if not parent_doc:
-            continue
-        chunk_records.append({
-            "id": str(uuid.uuid4()),
-            "doc_id": doc_id,
-            "user_id": user_id,
-            "parent_idx": p_idx,
-            "child_idx": c_idx,
-            "parent_text": parent_doc.page_content,
-            "child_text": child_doc.page_content,
-            "source": filename,
-            "page": parent_doc.metadata.get("page"),
-            "section": parent_doc.metadata.get("section", ""),
-        })
-
     if progress_callback:
         await progress_callback("chunking", 25)
 
     embeddings = _get_embeddings()
-    vectorstore_path = f"vectorstore/user_{user_id}"
-    os.makedirs(vectorstore_path, exist_ok=True)
-    faiss_path = os.path.join(vectorstore_path, "faiss_index")
-    bm25_path = os.path.join(vectorstore_path, "bm25_corpus.pkl")
-
-    def _build_faiss():
-        if os.path.exists(faiss_path):
-            store = FAISS.load_local(faiss_path, embeddings, allow_dangerous_deserialization=True)
-            store.add_documents(children)
-        else:
-            store = FAISS.from_documents(children, embeddings)
-        store.save_local(faiss_path)
+    os.makedirs(user_dir(user_id), exist_ok=True)
 
     if progress_callback:
         await progress_callback("embedding", 60)
 
-    await asyncio.to_thread(_build_faiss)
+    texts = [c.page_content for c in children]
+    vectors = await embedding_cache.mget(texts)
+    missing = [i for i, v in enumerate(vectors) if v is None]
+    if missing:
+        fresh = await embed_batch([texts[i] for i in missing])
+        for i, vec in zip(missing, fresh):
+            vectors[i] = vec
+        await embedding_cache.mset([texts[i] for i in missing], fresh)
+
+    await asyncio.to_thread(
+        add_embeddings, user_id, list(zip(texts, vectors)), [c.metadata for c in children], embeddings
+    )
 
-    existing: List[Document] = []
-    if os.path.exists(bm25_path):
-        async with aiofiles.open(bm25_path, "rb") as f:
-            data = await f.read()
-            existing = pickle.loads(data)
-    existing.extend(children)
-    async with aiofiles.open(bm25_path, "wb") as f:
-        await f.write(pickle.dumps(existing))
+    await asyncio.to_thread(append_bm25_corpus, user_id, children)
 
     if progress_callback:
         await progress_callback("indexing", 85)
 
-    conn = await get_db()
-    try:
+    pool = await get_pool()
+    async with pool.acquire() as conn:
         await insert_document(conn, doc_id, user_id, filename)
         await insert_chunks(conn, chunk_records)
-    finally:
-        await conn.close()
 
     if progress_callback:
         await progress_callback("done", 100)
 
     if graph_store is not None:
         from app.core.graph import update_user_graph
-        await update_user_graph(user_id, parents, graph_store)
+        await update_user_graph(user_id, [p for p, _ in sections], graph_store)
 
     return {"doc_id": doc_id, "filename": filename, "chunks": len(children)}
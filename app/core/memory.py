@@ -14,9 +14,12 @@ Rules:
 - Decision: {should_write, target, summary, confidence} — append only when confidence >= 0.80.
 """
 import asyncio
+import logging
 import os
+import re
 from datetime import datetime
-from typing import Optional
+from functools import lru_cache
+from typing import Optional, Set
 
 import aiofiles
 from langchain_ollama import ChatOllama
@@ -26,6 +29,8 @@ from langchain_core.output_parsers import JsonOutputParser
 from app.config import settings
 from app.schemas import MemoryEntry
 
+logger = logging.getLogger(__name__)
+
 MEMORY_PROMPT = """Analyze this conversation turn. Decide if it contains a high-signal fact worth storing.
 Respond with valid JSON only. No preamble.
 {{
@@ -50,6 +55,21 @@ Assistant: {answer}
 """
 
 
+# Plain questions ("what is X", "how do I Y") almost never carry a storable fact; the
+# judge call is skipped for them unless they also talk about the user or their org.
+_QUESTION_RE = re.compile(r"^\s*(what|why|how|when|where|who|which|is|are|does|do|can|could)\b", re.IGNORECASE)
+_SELF_RE = re.compile(r"\b(i|i'm|im|my|me|mine|we|our|us)\b", re.IGNORECASE)
+_NO_WRITE = {"written": False, "target": None, "summary": ""}
+_memory_tasks: Set[asyncio.Task] = set()
+
+
+def is_neutral_query(query: str) -> bool:
+    q = query.strip()
+    if len(q) < 12:
+        return True
+    return _QUESTION_RE.match(q) is not None and _SELF_RE.search(q) is None
+
+
 def _get_memory_llm():
     if settings.sanity_mock:
         from langchain_community.chat_models import FakeListChatModel
@@ -62,11 +82,23 @@ def _get_memory_llm():
     )
 
 
-async def extract_and_store_memory(user_id: str, query: str, answer: str) -> dict:
-    llm = _get_memory_llm()
+@lru_cache(maxsize=2)
+def _memory_chain(mock: bool):
     parser = JsonOutputParser(pydantic_object=MemoryEntry)
     prompt = PromptTemplate(template=MEMORY_PROMPT, input_variables=["query", "answer"])
-    chain = prompt | llm | parser
+    return prompt | _get_memory_llm() | parser
+
+
+@lru_cache(maxsize=2)
+def _insights_chain(mock: bool):
+    prompt = PromptTemplate(template=INSIGHTS_PROMPT, input_variables=["user_memory", "company_memory"])
+    return prompt | _get_memory_llm()
+
+
+async def extract_and_store_memory(user_id: str, query: str, answer: str) -> dict:
+    if is_neutral_query(query):
+        return dict(_NO_WRITE)
+    chain = _memory_chain(settings.sanity_mock)
 
     def _invoke():
         return chain.invoke({"query": query, "answer": answer})
@@ -75,7 +107,7 @@ async def extract_and_store_memory(user_id: str, query: str, answer: str) -> dic
     entry = MemoryEntry(**result)
 
     if not entry.should_write or entry.confidence < settings.memory_confidence_threshold or not entry.target:
-        return {"written": False, "target": None, "summary": ""}
+        return dict(_NO_WRITE)
 
     mem_dir = f"memory/user_{user_id}"
     os.makedirs(mem_dir, exist_ok=True)
@@ -95,6 +127,23 @@ async def extract_and_store_memory(user_id: str, query: str, answer: str) -> dic
     return {"written": True, "target": entry.target, "summary": entry.summary}
 
 
+def schedule_memory_extraction(user_id: str, query: str, answer: str) -> dict:
+    """Run the memory judge off the request path; returns the SSE `memory` payload right away."""
+    if is_neutral_query(query):
+        return dict(_NO_WRITE)
+
+    async def _run() -> None:
+        try:
+            await extract_and_store_memory(user_id, query, answer)
+        except Exception as e:
+            logger.warning("Memory extraction failed: %s", e)
+
+    task = asyncio.create_task(_run())
+    _memory_tasks.add(task)
+    task.add_done_callback(_memory_tasks.discard)
+    return {**_NO_WRITE, "queued": True}
+
+
 async def read_user_memory(user_id: str) -> str:
     """Read raw user memory content for RAG context injection."""
     mem_dir = f"memory/user_{user_id}"
@@ -138,9 +187,7 @@ async def get_memory_insights(user_id: str) -> str:
     if not user_mem.strip() and not company_mem.strip():
         return "• User: No entries yet\n• Company: No entries yet"
 
-    llm = _get_memory_llm()
-    prompt = PromptTemplate(template=INSIGHTS_PROMPT, input_variables=["user_memory", "company_memory"])
-    chain = prompt | llm
+    chain = _insights_chain(settings.sanity_mock)
 
     def _invoke():
         return chain.invoke({"user_memory": user_mem or "(empty)", "company_memory": company_mem or "(empty)"})
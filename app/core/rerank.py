@@ -0,0 +1,181 @@
+"""
+Cross-encoder reranking on ONNX Runtime with a dynamically INT8-quantized model.
+
+On first start the configured cross-encoder is exported to ONNX, its weights are
+quantized to int8 and both are cached under RERANKER_DIR; later starts only open the
+session. Without onnxruntime/optimum installed, load_reranker falls back to the
+PyTorch HuggingFaceCrossEncoder. Either way all candidate pairs are scored as one
+padded batch, so a query costs a single forward pass. RerankBatcher goes one step
+further under concurrent load and coalesces several queries' pairs into one pass.
+"""
+import asyncio
+import logging
+import os
+from typing import Any, List, Optional, Tuple
+
+import numpy as np
+from langchain_community.cross_encoders import HuggingFaceCrossEncoder
+from langchain_community.cross_encoders.base import BaseCrossEncoder
+from langchain_core.documents import Document
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+try:
+    import onnxruntime as ort
+    from tokenizers import Tokenizer
+except ImportError:
+    ort = None
+
+
+def _export_int8(model_name: str, out_dir: str) -> str:
+    """Export to ONNX once, then quantize with onnxruntime's dynamic int8 pass."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from optimum.onnxruntime import ORTModelForSequenceClassification
+    from transformers import AutoTokenizer
+
+    fp32_dir = os.path.join(out_dir, "fp32")
+    ORTModelForSequenceClassification.from_pretrained(model_name, export=True).save_pretrained(fp32_dir)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(out_dir)
+    int8_path = os.path.join(out_dir, "model_int8.onnx")
+    quantize_dynamic(os.path.join(fp32_dir, "model.onnx"), int8_path, weight_type=QuantType.QInt8)
+    return int8_path
+
+
+class OnnxCrossEncoder(BaseCrossEncoder):
+    """Drop-in BaseCrossEncoder for CrossEncoderReranker backed by an int8 ONNX session."""
+
+    def __init__(self, model_path: str, tokenizer_path: str, max_length: int = 256) -> None:
+        opts = ort.SessionOptions()
+        opts.intra_op_num_threads = _physical_cores()
+        opts.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(model_path, opts, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.tokenizer = Tokenizer.from_file(tokenizer_path)
+        self.tokenizer.enable_truncation(max_length=max_length)
+        self.tokenizer.enable_padding()
+
+    def score(self, text_pairs: List[Tuple[str, str]]) -> List[float]:
+        if not text_pairs:
+            return []
+        encodings = self.tokenizer.encode_batch(list(text_pairs))
+        feeds = {
+            "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+            "attention_mask": np.array([e.attention_mask for e in encodings], dtype=np.int64),
+            "token_type_ids": np.array([e.type_ids for e in encodings], dtype=np.int64),
+        }
+        logits = self.session.run(None, {k: v for k, v in feeds.items() if k in self.input_names})[0]
+        # Same convention as HuggingFaceCrossEncoder: two-logit models score on the "relevant" column.
+        return (logits[:, 1] if logits.ndim > 1 and logits.shape[1] > 1 else logits.reshape(-1)).tolist()
+
+
+class BatchedHFCrossEncoder(HuggingFaceCrossEncoder):
+    """HuggingFaceCrossEncoder that scores every pair in one batch instead of chunks of 32."""
+
+    def score(self, text_pairs: List[Tuple[str, str]]) -> List[float]:
+        if not text_pairs:
+            return []
+        scores = self.client.predict(text_pairs, batch_size=len(text_pairs), convert_to_numpy=True)
+        return (scores[:, 1] if scores.ndim > 1 else scores).tolist()
+
+
+class RerankBatcher:
+    """Request-coalescing front for a cross-encoder.
+
+    Callers queue their (query, passage) pairs; one worker task takes the first waiting
+    request, gathers whatever else arrives within `window` seconds (up to `max_requests`),
+    scores all of their pairs in a single model.score call off the event loop and hands
+    each caller back its own slice.
+    """
+
+    def __init__(self, model: BaseCrossEncoder, max_requests: int = 32, window: float = 0.005) -> None:
+        self.model = model
+        self.max_requests = max_requests
+        self.window = window
+        self._queue: "asyncio.Queue[Tuple[List[Tuple[str, str]], asyncio.Future]]" = asyncio.Queue()
+        self._worker: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def close(self) -> None:
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def score(self, pairs: List[Tuple[str, str]]) -> List[float]:
+        if not pairs:
+            return []
+        self.start()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((pairs, fut))
+        return await fut
+
+    async def rerank(self, query: str, docs: List[Document], top_n: int) -> List[Document]:
+        """Same ordering as CrossEncoderReranker.compress_documents: stable, best score first."""
+        scores = await self.score([(query, d.page_content) for d in docs])
+        ranked = sorted(zip(docs, scores), key=lambda ds: ds[1], reverse=True)
+        return [d for d, _ in ranked[:top_n]]
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.window
+            while len(batch) < self.max_requests:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            flat = [pair for pairs, _ in batch for pair in pairs]
+            try:
+                scores = await asyncio.to_thread(self.model.score, flat)
+            except Exception as e:
+                for _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(e)
+                continue
+            start = 0
+            for pairs, fut in batch:
+                # A caller that gave up (client disconnect) has a cancelled future; skip it.
+                if not fut.done():
+                    fut.set_result(scores[start:start + len(pairs)])
+                start += len(pairs)
+
+
+def _physical_cores() -> int:
+    return max(1, (os.cpu_count() or 2) // 2)
+
+
+def _warm(model: BaseCrossEncoder) -> BaseCrossEncoder:
+    # One throwaway pass so weight packing / kernel selection happens before real traffic.
+    model.score([("warmup", "warmup")])
+    return model
+
+
+def load_reranker() -> Any:
+    model_name = settings.reranker_model
+    if ort is not None and settings.reranker_onnx:
+        int8_path = os.path.join(settings.reranker_dir, "model_int8.onnx")
+        try:
+            if not os.path.exists(int8_path):
+                int8_path = _export_int8(model_name, settings.reranker_dir)
+            return _warm(OnnxCrossEncoder(
+                int8_path,
+                os.path.join(settings.reranker_dir, "tokenizer.json"),
+                max_length=settings.reranker_max_length,
+            ))
+        except Exception as e:
+            logger.warning("ONNX reranker unavailable, using PyTorch cross-encoder: %s", e)
+    import torch
+    torch.set_num_threads(_physical_cores())
+    return _warm(BatchedHFCrossEncoder(model_name=model_name, model_kwargs={"max_length": settings.reranker_max_length}))
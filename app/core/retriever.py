@@ -1,23 +1,40 @@
 import asyncio
-import os
-import pickle
-from typing import Any, Dict, List, Optional, Sequence
+import logging
+import re
+import weakref
+from functools import lru_cache
+from typing import Any, AsyncIterator, Callable, Dict, FrozenSet, List, Optional, Sequence, Set, Tuple
 
 from langchain.chains.hyde.base import HypotheticalDocumentEmbedder
 from langchain_community.cross_encoders import HuggingFaceCrossEncoder
-from langchain_community.retrievers import BM25Retriever
 from langchain_community.vectorstores import FAISS
 from langchain.retrievers import EnsembleRetriever
-from langchain.retrievers.document_compressors import CrossEncoderReranker
 from langchain_ollama import ChatOllama, OllamaEmbeddings
 from langchain_core.documents import Document
 from langchain_core.prompts import PromptTemplate
 from langchain_core.retrievers import BaseRetriever
+from langchain_core.vectorstores import VectorStoreRetriever
 from langchain_core.callbacks import CallbackManagerForRetrieverRun
 
 from app.config import settings
+from app.core.bm25 import SparseBM25Retriever
+from app.core.embeddings import preload_models
+from app.core.hyde import CachedHyDEEmbeddings
 from app.core.memory import read_user_memory
-from app.db import get_db, get_parent_texts
+from app.core.vectorstore import UserCache, index_stamp, load_bm25_corpus, load_bm25_index, read_faiss
+from app.db import cached_parent_map, get_parent_map, get_pool
+
+logger = logging.getLogger(__name__)
+
+Stamp = Tuple[int, int]
+
+_retrievers: "UserCache[str, Tuple[Stamp, EnsembleRetriever]]" = UserCache(settings.index_cache_users)
+# Distinct chunk sources per user, keyed by the same stamp as _retrievers.
+_sources: "UserCache[str, Tuple[Stamp, FrozenSet[str]]]" = UserCache(settings.index_cache_users)
+_retriever_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
+_CROSS_DOC_RE = re.compile(r"compare|difference|both|versus|vs|contrast", re.IGNORECASE)
+# The loop holds only weak references to tasks; keep fire-and-forget cache writes alive.
+_background_tasks: Set[asyncio.Task] = set()
 
 RAG_PROMPT = """You are a precise research assistant with access to both a knowledge graph and document chunks.
 Answer ONLY using the provided CONTEXT (graph facts + document chunks).
@@ -47,15 +64,17 @@ QUESTION: {question}
 """
 
 
-def _get_embeddings():
-    if settings.sanity_mock:
+@lru_cache(maxsize=2)
+def _embeddings_for(mock: bool):
+    if mock:
         from langchain_community.embeddings import FakeEmbeddings
         return FakeEmbeddings(size=768)
     return OllamaEmbeddings(model=settings.ollama_embed_model, base_url=settings.ollama_base_url)
 
 
-def _get_llm():
-    if settings.sanity_mock:
+@lru_cache(maxsize=2)
+def _llm_for(mock: bool):
+    if mock:
         from langchain_community.chat_models import FakeListChatModel
         return FakeListChatModel(responses=["I don't have enough information in the uploaded documents to answer this."])
     return ChatOllama(
@@ -66,22 +85,69 @@ def _get_llm():
     )
 
 
-def _get_hyde_embeddings():
-    if settings.sanity_mock:
+def _with_temperature(llm: ChatOllama, temperature: float):
+    """`llm` with a per-call temperature override.
+
+    langchain-ollama 0.1 only honours per-call overrides at the top level of its request
+    params, so the temperature rides in a full copy of the private "options" dict; a
+    release without it gets the plain bind.
+    """
+    try:
+        options = llm._default_params["options"]
+    except (AttributeError, KeyError, TypeError):
+        options = None
+    if not isinstance(options, dict):
+        return llm.bind(temperature=temperature)
+    return llm.bind(options={**options, "temperature": temperature})
+
+
+@lru_cache(maxsize=2)
+def _hyde_embeddings_for(mock: bool):
+    if mock:
         from langchain_community.embeddings import FakeEmbeddings
         return FakeEmbeddings(size=768)
-    base_emb = OllamaEmbeddings(model=settings.ollama_embed_model, base_url=settings.ollama_base_url)
-    llm = ChatOllama(model=settings.ollama_chat_model, base_url=settings.ollama_base_url, temperature=0.4)
-    return HypotheticalDocumentEmbedder.from_llm(llm, base_emb, "web_search")
+    # Reuse the query-time embeddings and chat clients (and their connection pools).
+    base_emb = _embeddings_for(False)
+    hyde_llm = _with_temperature(_llm_for(False), 0.4)
+    hyde = HypotheticalDocumentEmbedder.from_llm(hyde_llm, base_emb, "web_search")
+    return CachedHyDEEmbeddings(hyde, base_emb, settings.hyde_cache_path, maxsize=settings.hyde_cache_size)
+
+
+def _get_llm():
+    return _llm_for(settings.sanity_mock)
+
+
+def _get_embeddings():
+    return _embeddings_for(settings.sanity_mock)
+
+
+def _get_hyde_embeddings():
+    return _hyde_embeddings_for(settings.sanity_mock)
+
+
+async def warm_up() -> None:
+    """Build the model clients once and load the Ollama models before the first query.
+
+    Runs as a background task, so failures are logged here rather than lost with it.
+    """
+    try:
+        _get_embeddings()
+        _get_hyde_embeddings()
+        _get_llm()
+        if not settings.sanity_mock:
+            await preload_models()
+    except Exception as e:
+        logger.warning("Model warm-up failed: %s", e)
 
 
 class HyDEFAISSRetriever(BaseRetriever):
     """FAISS retriever that uses HyDE for query embedding."""
     store: FAISS
-    hyde_embeddings: HypotheticalDocumentEmbedder
+    hyde_embeddings: Any
     k: int = 8
     fetch_k: int = 30
     lambda_mult: float = 0.7
+    filter: Optional[Callable[[dict], bool]] = None
 
     def _get_relevant_documents(
         self,
@@ -95,33 +161,20 @@ class HyDEFAISSRetriever(BaseRetriever):
             k=self.k,
             fetch_k=self.fetch_k,
             lambda_mult=self.lambda_mult,
+            filter=self.filter,
         )
 
 
-def build_bm25_retriever(user_docs: List[Document], k: int = 8) -> BM25Retriever:
-    retriever = BM25Retriever.from_documents(user_docs, k=k)
-    retriever.k = k
-    return retriever
-
-
-def _get_retriever(user_id: str) -> Optional[Any]:
-    vectorstore_path = f"vectorstore/user_{user_id}"
-    faiss_path = os.path.join(vectorstore_path, "faiss_index")
-    bm25_path = os.path.join(vectorstore_path, "bm25_corpus.pkl")
+def build_bm25_retriever(user_id: str, k: int = 8) -> SparseBM25Retriever:
+    docs = load_bm25_corpus(user_id)
+    return SparseBM25Retriever(docs=docs, index=load_bm25_index(user_id, docs), k=k)
 
-    if not os.path.exists(faiss_path):
-        return None
-
-    embeddings = _get_embeddings()
-    store = FAISS.load_local(faiss_path, embeddings, allow_dangerous_deserialization=True)
 
-    docs_for_bm25: List[Document] = []
-    if os.path.exists(bm25_path):
-        with open(bm25_path, "rb") as f:
-            docs_for_bm25 = pickle.load(f)
+def _build_retriever(user_id: str) -> EnsembleRetriever:
+    # Ingest appends to its cached shard in place; queries search their own copy.
+    store = read_faiss(user_id, _get_embeddings())
 
-    bm25_retriever = build_bm25_retriever(docs_for_bm25, k=settings.retrieval_k)
-    bm25_retriever.k = settings.retrieval_k
+    bm25_retriever = build_bm25_retriever(user_id, k=settings.retrieval_k)
 
     if settings.hyde_enabled and not settings.sanity_mock:
         hyde_emb = _get_hyde_embeddings()
@@ -148,19 +201,106 @@ def _get_retriever(user_id: str) -> Optional[Any]:
     )
 
 
+def _get_retriever(user_id: str) -> Optional[Tuple[Stamp, EnsembleRetriever]]:
+    """(index stamp, retriever) for a user, rebuilt only when the shard or BM25 corpus changes on disk."""
+    stamp = index_stamp(user_id)
+    if stamp is None:
+        _retrievers.pop(user_id, None)
+        _sources.pop(user_id, None)
+        return None
+    cached = _retrievers.get(user_id)
+    if cached and cached[0] == stamp:
+        return cached
+    entry = (stamp, _build_retriever(user_id))
+    _retrievers[user_id] = entry
+    return entry
+
+
+async def _acquire_retriever(user_id: str) -> Optional[Tuple[Stamp, EnsembleRetriever]]:
+    # One builder per user; concurrent queries wait for it instead of all loading the shard.
+    lock = _retriever_locks.get(user_id)
+    if lock is None:
+        lock = _retriever_locks[user_id] = asyncio.Lock()
+    async with lock:
+        return await asyncio.to_thread(_get_retriever, user_id)
+
+
+def _metadata_predicate(
+    filter_source: Optional[str] = None,
+    filter_section: Optional[str] = None,
+    filter_page: Optional[int] = None,
+) -> Optional[Callable[[dict], bool]]:
+    """apply_metadata_filters' test on one metadata dict, for pushing filters into search."""
+    if not filter_source and not filter_section and filter_page is None:
+        return None
+    section = filter_section.lower() if filter_section else None
+
+    def _keep(meta: dict) -> bool:
+        return (
+            (not filter_source or meta.get("source") == filter_source)
+            and (filter_page is None or meta.get("page") == filter_page)
+            and (section is None or section in (meta.get("section") or "").lower())
+        )
+
+    return _keep
+
+
+def _corpus_sources(user_id: str, stamp: Stamp, retriever: EnsembleRetriever) -> FrozenSet[str]:
+    """Every source filename in the user's current index (one entry per upload)."""
+    cached = _sources.get(user_id)
+    if cached and cached[0] == stamp:
+        return cached[1]
+    bm25 = next(r for r in retriever.retrievers if isinstance(r, SparseBM25Retriever))
+    sources = frozenset(d.metadata.get("source") for d in bm25.docs)
+    _sources[user_id] = (stamp, sources)
+    return sources
+
+
+def _with_filter(retriever: BaseRetriever, where: Callable[[dict], bool]) -> BaseRetriever:
+    # Shallow per-query copy; the cached ensemble members stay unfiltered.
+    if isinstance(retriever, VectorStoreRetriever):
+        return retriever.copy(update={"search_kwargs": {**retriever.search_kwargs, "filter": where}})
+    return retriever.copy(update={"filter": where})
+
+
+async def _hybrid_search(
+    retriever: EnsembleRetriever,
+    query: str,
+    where: Optional[Callable[[dict], bool]] = None,
+) -> List[Document]:
+    """Run each member retriever in its own thread and fuse with the ensemble's weighted RRF.
+
+    With `where`, both members only return matching chunks, so filtered queries fill
+    their top-k from the filtered set instead of discarding non-matches afterwards.
+    """
+    members = retriever.retrievers if where is None else [_with_filter(r, where) for r in retriever.retrievers]
+    doc_lists = await asyncio.gather(
+        *(asyncio.to_thread(r.invoke, query) for r in members)
+    )
+    return retriever.weighted_reciprocal_rank(list(doc_lists))
+
+
+def _chunk_key(meta: dict) -> tuple:
+    return meta.get("doc_id"), meta.get("parent_idx"), meta.get("child_idx")
+
+
 def apply_metadata_filters(
     docs: List[Document],
     filter_source: Optional[str] = None,
     filter_section: Optional[str] = None,
     filter_page: Optional[int] = None,
 ) -> List[Document]:
-    result = docs
-    if filter_source:
-        result = [d for d in result if d.metadata.get("source") == filter_source]
-    if filter_section:
-        result = [d for d in result if filter_section.lower() in (d.metadata.get("section") or "").lower()]
-    if filter_page is not None:
-        result = [d for d in result if d.metadata.get("page") == filter_page]
+    if not filter_source and not filter_section and filter_page is None:
+        return docs
+    section = filter_section.lower() if filter_section else None
+    # Predicates inline (no per-doc call); the equality tests run first so the
+    # lowercase + substring test only happens for docs that already matched them.
+    result = [
+        d for d in docs
+        if (not filter_source or d.metadata.get("source") == filter_source)
+        and (filter_page is None or d.metadata.get("page") == filter_page)
+        and (section is None or section in (d.metadata.get("section") or "").lower())
+    ]
     return result if result else docs
 
 
@@ -168,35 +308,31 @@ async def expand_to_parents(
     user_id: str,
     child_docs: List[Document],
 ) -> List[Document]:
-    """Replace retrieved child chunks with their full parent paragraphs from SQLite."""
-    seen: set = set()
-    parent_keys: List[tuple] = []
-    for doc in child_docs:
-        meta = doc.metadata
-        doc_id = meta.get("doc_id")
-        parent_idx = meta.get("parent_idx", 0)
-        key = (doc_id, parent_idx)
-        if key not in seen:
-            seen.add(key)
-            parent_keys.append((doc_id, parent_idx))
-
-    conn = await get_db()
-    try:
-        texts = await get_parent_texts(conn, user_id, parent_keys)
-    finally:
-        await conn.close()
+    """Replace retrieved child chunks with their full parent paragraphs.
+
+    Parents come from the per-user in-memory map in app.db, keyed on the index stamp,
+    so only the first query after an upload or delete touches SQLite. A child whose
+    parent is missing from a cached map forces one reload before falling back.
+    """
+    if not child_docs:
+        return []
+    keys = [(doc.metadata.get("doc_id"), doc.metadata.get("parent_idx", 0)) for doc in child_docs]
+    stamp = index_stamp(user_id)
+    parents = cached_parent_map(user_id, stamp)
+    if parents is None or any(key not in parents for key in keys):
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            parents = await get_parent_map(conn, user_id, stamp, refresh=parents is not None)
 
-    key_to_text = {k: t for k, t in zip(parent_keys, texts)}
     expanded: List[Document] = []
-    for doc in child_docs:
-        key = (doc.metadata.get("doc_id"), doc.metadata.get("parent_idx", 0))
-        parent_text = key_to_text.get(key, doc.page_content)
-        expanded.append(
-            Document(
-                page_content=parent_text,
-                metadata=dict(doc.metadata),
-            )
-        )
+    for doc, key in zip(child_docs, keys):
+        meta = doc.metadata
+        parent_text = parents.get(key)
+        if parent_text is None or parent_text == doc.page_content:
+            expanded.append(doc)
+        else:
+            # Metadata is read-only downstream (filters, prompt headers, citations), so share it.
+            expanded.append(Document(page_content=parent_text, metadata=meta))
     return expanded
 
 
@@ -208,28 +344,77 @@ async def ask_stream(
     filter_page: Optional[int] = None,
     graph_store: Optional[Dict[str, Any]] = None,
     reranker_model: Optional[Any] = None,
-) -> Dict[str, Any]:
-    retriever = _get_retriever(user_id)
-    if not retriever:
-        return {"answer": "No documents indexed yet. Please upload a file first.", "citations": [], "source_docs": []}
-
-    from app.core.cache import query_cache
+) -> AsyncIterator[Dict[str, Any]]:
+    """Yield SSE-ready events: a single "cached" event, or "citations" then "token" events."""
+    entry = await _acquire_retriever(user_id)
+    if not entry:
+        yield {"type": "citations", "data": []}
+        yield {"type": "token", "text": "No documents indexed yet. Please upload a file first."}
+        return
+    stamp, retriever = entry
+
+    from app.core.cache import query_cache, semantic_cache
     cached = await query_cache.get(user_id, query)
     if cached:
-        return {"answer": cached["answer"], "citations": cached["citations"], "cached": True}
+        yield {"type": "cached", "answer": cached["answer"], "citations": cached["citations"]}
+        return
+
+    # Graph context and user memory don't depend on the retrieved chunks; start them now.
+    graph_task = None
+    user_graph = None
+    if graph_store is not None:
+        from app.core.graph import aget_graph, get_graph_context
+        user_graph = await aget_graph(graph_store, user_id)
+    if user_graph is not None and user_graph.number_of_nodes():
+        graph_task = asyncio.create_task(get_graph_context(query, user_id, graph_store))
+    memory_task = asyncio.create_task(read_user_memory(user_id))
+    # Plain query embedding for the semantic cache, computed alongside retrieval.
+    query_vec_task = None
+    if settings.semantic_cache_enabled:
+        query_vec_task = asyncio.create_task(asyncio.to_thread(_get_embeddings().embed_query, query))
+
+    def _cancel_side_tasks() -> None:
+        for task in (graph_task, memory_task, query_vec_task):
+            if task is not None:
+                task.cancel()
 
-    def _retrieve():
-        return retriever.invoke(query)
-
-    raw_docs = await asyncio.to_thread(_retrieve)
+    try:
+        where = _metadata_predicate(filter_source, filter_section, filter_page)
+        if where is not None and filter_source and filter_source not in _corpus_sources(user_id, stamp, retriever):
+            # Unknown (typo'd / deleted) source: nothing can match, so skip the filtered pass.
+            where = None
+        raw_docs = await _hybrid_search(retriever, query, where)
+        if not raw_docs and where is not None:
+            # Nothing matches the filters: answer from everything, as apply_metadata_filters does.
+            raw_docs = await _hybrid_search(retriever, query)
+    except BaseException:
+        _cancel_side_tasks()
+        raise
     if not raw_docs:
-        return {"answer": "I don't have enough information in the uploaded documents to answer this.", "citations": [], "source_docs": []}
+        _cancel_side_tasks()
+        yield {"type": "citations", "data": []}
+        yield {"type": "token", "text": "I don't have enough information in the uploaded documents to answer this."}
+        return
+
+    # Paraphrases answered against the same index, filters and retrieved chunks reuse that answer.
+    cache_scope = (stamp, filter_source, filter_section, filter_page)
+    chunk_ids = frozenset(_chunk_key(d.metadata) for d in raw_docs)
+    query_vec = None
+    if query_vec_task is not None:
+        try:
+            query_vec = await query_vec_task
+        except Exception as e:
+            logger.debug("Semantic cache skipped, query embedding failed: %s", e)
+    if query_vec is not None:
+        hit = semantic_cache.lookup(user_id, cache_scope, query_vec, chunk_ids)
+        if hit is not None:
+            _cancel_side_tasks()
+            yield {"type": "cached", "answer": hit["answer"], "citations": hit["citations"]}
+            return
 
     if len(raw_docs) >= 4 and reranker_model is not None and not settings.sanity_mock:
-        compressor = CrossEncoderReranker(model=reranker_model, top_n=4)
-        def _compress():
-            return compressor.compress_documents(raw_docs, query)
-        reranked = await asyncio.to_thread(_compress)
+        # reranker_model is the app's RerankBatcher: concurrent queries share one forward pass.
+        reranked = await reranker_model.rerank(query, raw_docs, top_n=4)
         docs_to_use = reranked if reranked else raw_docs
     else:
         docs_to_use = raw_docs
@@ -237,17 +422,34 @@ async def ask_stream(
     filtered = apply_metadata_filters(docs_to_use, filter_source, filter_section, filter_page)
     context_docs = await expand_to_parents(user_id, filtered)
 
-    graph_context = ""
-    if graph_store:
-        from app.core.graph import get_graph_context
-        graph_context = await get_graph_context(query, user_id, graph_store)
+    # Sources are known once retrieval is done; send them ahead of the first token so
+    # clients can render citation previews while the answer streams.
+    citations = []
+    for d in context_docs[:5]:
+        meta = d.metadata
+        citations.append({
+            "source": meta.get("source", "unknown"),
+            "chunk_index": meta.get("child_idx", meta.get("parent_idx", -1)),
+            "section": meta.get("section", ""),
+            "page": meta.get("page"),
+            "excerpt": d.page_content[:150] + ("..." if len(d.page_content) > 150 else ""),
+        })
+
+    try:
+        yield {"type": "citations", "data": citations}
+    except BaseException:
+        # Client went away before the answer; graph/memory lookups may still be running.
+        _cancel_side_tasks()
+        raise
+
+    graph_context = await graph_task if graph_task is not None else ""
 
     context_parts = []
     for d in context_docs:
-        meta = d.metadata
+        meta_get = d.metadata.get
         header = (
-            f"[Source: {meta.get('source', '?')} | Section: {meta.get('section', '?')} "
-            f"| Page: {meta.get('page', '?')} | Chunk {meta.get('child_idx', 0)}]\n"
+            f"[Source: {meta_get('source', '?')} | Section: {meta_get('section', '?')} "
+            f"| Page: {meta_get('page', '?')} | Chunk {meta_get('child_idx', 0)}]\n"
         )
         context_parts.append(header + d.page_content)
 
@@ -258,35 +460,28 @@ async def ask_stream(
     else:
         full_context = context
 
-    user_memory = await read_user_memory(user_id)
+    user_memory = await memory_task
     memory_context = ""
     if user_memory and user_memory.strip():
         summary = user_memory.strip()[:500]
         memory_context = f"Known facts about this user (preferred when relevant):\n{summary}\n\n"
 
-    is_cross_doc = any(kw in query.lower() for kw in ["compare", "difference", "both", "versus", "vs", "contrast"])
+    is_cross_doc = _CROSS_DOC_RE.search(query) is not None
     prompt_template = CROSS_DOC_PROMPT if is_cross_doc else RAG_PROMPT
     prompt = PromptTemplate(template=prompt_template, input_variables=["context", "question", "memory_context"])
     llm = _get_llm()
     chain = prompt | llm
 
-    def _invoke():
-        return chain.invoke({"context": full_context, "question": query, "memory_context": memory_context})
-
-    answer = await asyncio.to_thread(_invoke)
-    answer_text = answer.content if hasattr(answer, "content") else str(answer)
-
-    citations = []
-    for d in context_docs[:5]:
-        meta = d.metadata
-        citations.append({
-            "source": meta.get("source", "unknown"),
-            "chunk_index": meta.get("child_idx", meta.get("parent_idx", -1)),
-            "section": meta.get("section", ""),
-            "page": meta.get("page"),
-            "excerpt": d.page_content[:150] + ("..." if len(d.page_content) > 150 else ""),
-        })
-
-    result = {"answer": answer_text, "citations": citations, "source_docs": context_docs}
-    asyncio.create_task(query_cache.set(user_id, query, {"answer": answer_text, "citations": citations}))
-    return result
+    parts: List[str] = []
+    async for chunk in chain.astream({"context": full_context, "question": query, "memory_context": memory_context}):
+        text = chunk.content if hasattr(chunk, "content") else str(chunk)
+        if text:
+            parts.append(text)
+            yield {"type": "token", "text": text}
+    answer_text = "".join(parts)
+
+    if query_vec is not None:
+        semantic_cache.store(user_id, cache_scope, query_vec, chunk_ids, {"answer": answer_text, "citations": citations})
+    task = asyncio.create_task(query_cache.set(user_id, query, {"answer": answer_text, "citations": citations}))
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
@@ -1,4 +1,8 @@
+import threading
+from typing import Optional
+
 import httpx
+import numpy as np
 from langchain.agents import AgentType, initialize_agent
 from langchain.tools import tool
 from langchain_ollama import ChatOllama
@@ -8,6 +12,60 @@ from app.config import settings
 
 OUTPUT_MAX_CHARS = 4000
 
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+_client: Optional[httpx.Client] = None
+_client_lock = threading.Lock()
+
+
+def _get_client() -> httpx.Client:
+    """One pooled keep-alive client for every tool call (agent runs may use worker threads)."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = httpx.Client(
+                    http2=_HTTP2,
+                    timeout=15,
+                    limits=httpx.Limits(max_keepalive_connections=32),
+                )
+    return _client
+
+
+def _series_stats(values: list) -> dict:
+    """Vectorised summary of a daily series; None entries count as missing."""
+    arr = np.asarray(values, dtype=np.float64)  # None -> nan
+    valid = arr[~np.isnan(arr)]
+    if not valid.size:
+        return {"error": "No valid data"}
+    avg = valid.mean()
+    std = valid.std()
+    rolling_7 = np.convolve(valid, np.full(7, 1 / 7), mode="valid") if valid.size > 6 else None
+    anomalies = int((np.abs(valid - avg) > 2 * std).sum()) if std > 0 else 0
+    return {
+        "average": round(float(avg), 2),
+        "std_dev": round(float(std), 2),
+        "rolling_7_avg": round(float(rolling_7.mean()), 2) if rolling_7 is not None else None,
+        "anomaly_count": anomalies,
+        "missing_pct": round((arr.size - valid.size) / arr.size * 100, 1),
+    }
+
+
+_ANALYSIS_SCRIPT = """
+def analyze(values):
+    if not values:
+        return {"error": "No data"}
+    return series_stats(values)
+result = analyze(values)
+"""
+# The script is constant, so the restricted AST transform and compile happen once at import.
+_ANALYSIS_CODE = compile_restricted(_ANALYSIS_SCRIPT, "<analysis>", "exec")
+_ANALYSIS_GLOBALS = {**safe_globals, "series_stats": _series_stats}
+
 
 @tool
 def open_meteo_analysis(
@@ -27,9 +85,9 @@ def open_meteo_analysis(
     }
     daily_var = var_map.get(variable, "temperature_2m_max")
 
+    client = _get_client()
     geo_url = f"https://geocoding-api.open-meteo.com/v1/search?name={location}&count=1&language=en&format=json"
-    with httpx.Client(timeout=10) as client:
-        geo_res = client.get(geo_url).json()
+    geo_res = client.get(geo_url, timeout=10).json()
 
     if not geo_res.get("results"):
         return f"Could not find location: {location}"
@@ -41,35 +99,15 @@ def open_meteo_analysis(
         f"https://archive-api.open-meteo.com/v1/archive?"
         f"latitude={lat}&longitude={lon}&start_date={start_date}&end_date={end_date}&daily={daily_var}"
     )
-    with httpx.Client(timeout=15) as client:
-        data = client.get(weather_url).json()
+    data = client.get(weather_url).json()
 
     if "daily" not in data:
         return f"Error fetching weather data: {data}"
 
     values = data["daily"][daily_var]
-    analysis_script = """
-def analyze(values):
-    if not values:
-        return {"error": "No data"}
-    valid = [v for v in values if v is not None]
-    if not valid:
-        return {"error": "No valid data"}
-    n = len(valid)
-    avg = sum(valid) / n
-    variance = sum((x - avg) ** 2 for x in valid) / n
-    std = variance ** 0.5 if variance > 0 else 0
-    rolling_7 = [sum(valid[i-6:i+1])/7 for i in range(6, n)] if n > 6 else []
-    anomalies = sum(1 for i, v in enumerate(valid) if std > 0 and abs((v - avg) / std) > 2)
-    missing_pct = round((len(values) - len(valid)) / len(values) * 100, 1) if values else 0
-    return {"average": round(avg, 2), "std_dev": round(std, 2),
-            "rolling_7_avg": round(sum(rolling_7)/len(rolling_7), 2) if rolling_7 else None,
-            "anomaly_count": anomalies, "missing_pct": missing_pct}
-result = analyze(values)
-"""
-    loc = {}
-    exec(compile_restricted(analysis_script, "<string>", "exec"), safe_globals, loc)
-    ar = loc["analyze"](values)
+    loc = {"values": values}
+    exec(_ANALYSIS_CODE, _ANALYSIS_GLOBALS, loc)
+    ar = loc["result"]
     return (
         f"Location: {location} | {start_date} to {end_date} | {variable}\n"
         f"Avg: {ar.get('average')} | Std: {ar.get('std_dev')} | "
@@ -0,0 +1,415 @@
+"""
+Per-user FAISS shards and BM25 corpora.
+
+Shards live on disk under vectorstore/user_{id}/faiss_index and are kept in memory
+between uploads, so adding a document only pays for the new vectors instead of
+re-reading the whole index. The cached copy is keyed on the on-disk mtime, so a
+shard rewritten by another worker process is picked up on next access.
+
+Vectors carry explicit int64 chunk ids. Each shard moves up a tier as it grows, with
+its vectors reconstructed and the new quantizer trained on all of them:
+
+  < FAISS_SQ_MIN     IDMap2,Flat   exact fp32
+  < FAISS_TRAIN_MIN  IDMap2,SQ8    per-dimension int8, 4x smaller
+  otherwise          IVF256,PQ32   32-byte product codes, ~100x smaller at 768 dims
+
+The BM25 corpus is an append-only stream of msgpack records ({"t": text, "m": metadata})
+in bm25_corpus.mpk. Uploads append only their own chunks; the decoded corpus is cached
+per user and keyed on file size. Its term-frequency index (app.core.bm25) is kept
+alongside in bm25_index.mpk and extended with just the new chunks on each upload.
+
+Every in-memory copy is held for at most INDEX_CACHE_USERS users (least recently used
+first out); an evicted user's next request reloads from disk.
+"""
+import logging
+import os
+import pickle
+import shutil
+import sys
+import threading
+import uuid
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+import faiss
+import msgpack
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_core.documents import Document
+
+from app.config import settings
+from app.core.bm25 import BM25Index, load_index, save_index
+
+logger = logging.getLogger(__name__)
+
+
+class UserCache(OrderedDict):
+    """user_id -> cached entry, LRU-bounded like GraphStore.
+
+    Loads run in worker threads, so lookups and inserts take a lock; `get` counts as a
+    use and moves the user to the back of the eviction order.
+    """
+
+    def __init__(self, maxsize: int) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str, default: Any = None) -> Any:
+        with self._lock:
+            if user_id not in self:
+                return default
+            self.move_to_end(user_id)
+            return super().__getitem__(user_id)
+
+    def __setitem__(self, user_id: str, entry: Any) -> None:
+        with self._lock:
+            super().__setitem__(user_id, entry)
+            self.move_to_end(user_id)
+            while len(self) > self.maxsize:
+                self.popitem(last=False)
+
+
+_stores: "UserCache[str, Tuple[int, FAISS]]" = UserCache(settings.index_cache_users)
+_corpora: "UserCache[str, Tuple[int, List[Document]]]" = UserCache(settings.index_cache_users)
+_bm25_indexes: "UserCache[str, Tuple[int, BM25Index]]" = UserCache(settings.index_cache_users)
+
+
+def user_dir(user_id: str) -> str:
+    return f"vectorstore/user_{user_id}"
+
+
+def faiss_path(user_id: str) -> str:
+    return os.path.join(user_dir(user_id), "faiss_index")
+
+
+def bm25_path(user_id: str) -> str:
+    return os.path.join(user_dir(user_id), "bm25_corpus.mpk")
+
+
+def bm25_index_path(user_id: str) -> str:
+    return os.path.join(user_dir(user_id), "bm25_index.mpk")
+
+
+def _mtime(path: str) -> Optional[int]:
+    try:
+        return os.stat(os.path.join(path, "index.faiss")).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def _tiers() -> List[Tuple[int, str]]:
+    """(min shard size, factory) from largest to smallest; the exact flat tier always applies."""
+    tiers = []
+    if settings.faiss_index_factory != "Flat":
+        # IVF indexes store their own ids, so they are not wrapped in IDMap2.
+        tiers.append((settings.faiss_train_min, settings.faiss_index_factory))
+    if settings.faiss_sq_factory != "Flat":
+        tiers.append((settings.faiss_sq_min, "IDMap2," + settings.faiss_sq_factory))
+    return tiers + [(0, "IDMap2,Flat")]
+
+
+def _build_index(dim: int, factory: str) -> Optional[faiss.Index]:
+    try:
+        index = faiss.index_factory(dim, factory)
+    except RuntimeError as e:  # e.g. PQ sub-quantizer count not dividing dim
+        logger.warning("FAISS factory %r unusable for dim %d: %s", factory, dim, e)
+        return None
+    # FastScan (x4fs) codes segfault in reconstruct() once read back from disk,
+    # and MMR reconstructs every candidate.
+    if isinstance(index, faiss.IndexIVFFastScan):
+        logger.warning("FAISS factory %r is FastScan, which MMR cannot use", factory)
+        return None
+    return index
+
+
+def _new_index(dim: int, n: int) -> faiss.Index:
+    for min_n, factory in _tiers():
+        if n >= min_n:
+            index = _build_index(dim, factory)
+            if index is not None:
+                return index
+    return faiss.index_factory(dim, "IDMap2,Flat")
+
+
+def _tier(index: faiss.Index) -> int:
+    """0 exact, 1 scalar-quantized, 2 IVF; -1 for a positional index written before chunk ids."""
+    if isinstance(index, faiss.IndexIVF):
+        return 2
+    if isinstance(index, faiss.IndexIDMap):
+        return 0 if isinstance(faiss.downcast_index(index.index), faiss.IndexFlat) else 1
+    return -1
+
+
+def _target_tier(n: int) -> int:
+    if settings.faiss_index_factory != "Flat" and n >= settings.faiss_train_min:
+        return 2
+    if settings.faiss_sq_factory != "Flat" and n >= settings.faiss_sq_min:
+        return 1
+    return 0
+
+
+def _tune(index: faiss.Index) -> None:
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = settings.faiss_nprobe
+        # Hashtable rather than array direct map so reconstruct (MMR) survives remove_ids.
+        index.set_direct_map_type(faiss.DirectMap.Hashtable)
+
+
+def _reindex(store: FAISS, incoming: np.ndarray) -> None:
+    """Move a shard's vectors into a freshly trained index for its new size, keeping their ids."""
+    old = store.index
+    n = old.ntotal
+    index = _new_index(old.d, n + len(incoming))
+    if _tier(old) >= 0 and _tier(index) <= _tier(old):
+        return  # the larger tier's factory is unusable here; keep what we have
+    if isinstance(old, faiss.IndexIDMap):
+        ids = faiss.vector_to_array(old.id_map).astype(np.int64)
+        vectors = old.index.reconstruct_n(0, n)
+    else:
+        ids = np.arange(n, dtype=np.int64)
+        vectors = old.reconstruct_n(0, n)
+    if not index.is_trained:
+        # Quantizers are calibrated on every vector the shard will hold, not just the new ones.
+        index.train(np.vstack([vectors, incoming]))
+    _tune(index)
+    index.add_with_ids(vectors, ids)
+    store.index = index
+
+
+def _add(store: FAISS, texts: List[str], vectors: np.ndarray, metadatas: List[dict]) -> None:
+    start = max(store.index_to_docstore_id, default=-1) + 1
+    ids = np.arange(start, start + len(texts), dtype=np.int64)
+    if _tier(store.index) < _target_tier(store.index.ntotal + len(ids)):
+        _reindex(store, vectors)
+    if not store.index.is_trained:
+        store.index.train(vectors)
+        _tune(store.index)
+    store.index.add_with_ids(vectors, ids)
+    docs = {}
+    for chunk_id, text, metadata in zip(ids.tolist(), texts, metadatas):
+        doc_id = str(uuid.uuid4())
+        docs[doc_id] = Document(page_content=text, metadata=metadata)
+        store.index_to_docstore_id[chunk_id] = doc_id
+    store.docstore.add(docs)
+
+
+def load_faiss(user_id: str, embeddings: Any) -> Optional[FAISS]:
+    path = faiss_path(user_id)
+    mtime = _mtime(path)
+    if mtime is None:
+        _stores.pop(user_id, None)
+        return None
+    cached = _stores.get(user_id)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    store = read_faiss(user_id, embeddings)
+    _stores[user_id] = (mtime, store)
+    return store
+
+
+def read_faiss(user_id: str, embeddings: Any) -> FAISS:
+    """A private copy of the shard from disk, not shared with the ingest-side cache."""
+    store = FAISS.load_local(faiss_path(user_id), embeddings, allow_dangerous_deserialization=True)
+    _tune(store.index)
+    return store
+
+
+def save_faiss(user_id: str, store: FAISS) -> None:
+    path = faiss_path(user_id)
+    store.save_local(path)
+    _stores[user_id] = (_mtime(path), store)
+
+
+def build_faiss(
+    text_embeddings: List[Tuple[str, List[float]]],
+    metadatas: List[dict],
+    embeddings: Any,
+) -> FAISS:
+    texts = [t for t, _ in text_embeddings]
+    vectors = np.asarray([v for _, v in text_embeddings], dtype=np.float32)
+    store = FAISS(embeddings, _new_index(vectors.shape[1], len(texts)), InMemoryDocstore(), {})
+    _add(store, texts, vectors, metadatas)
+    return store
+
+
+def add_embeddings(
+    user_id: str,
+    text_embeddings: List[Tuple[str, List[float]]],
+    metadatas: List[dict],
+    embeddings: Any,
+) -> FAISS:
+    """Append precomputed vectors to the user's shard, creating it on first upload."""
+    store = load_faiss(user_id, embeddings)
+    if store is None:
+        store = build_faiss(text_embeddings, metadatas, embeddings)
+    else:
+        vectors = np.asarray([v for _, v in text_embeddings], dtype=np.float32)
+        _add(store, [t for t, _ in text_embeddings], vectors, metadatas)
+    save_faiss(user_id, store)
+    return store
+
+
+def index_stamp(user_id: str) -> Optional[Tuple[int, int]]:
+    """(shard mtime, BM25 log size), or None when the user has no shard yet."""
+    mtime = _mtime(faiss_path(user_id))
+    if mtime is None:
+        return None
+    return mtime, _file_size(bm25_path(user_id))
+
+
+def _remove_vectors(store: FAISS, chunk_ids: List[int]) -> None:
+    ids = np.asarray(chunk_ids, dtype=np.int64)
+    if _tier(store.index) >= 0:
+        store.index.remove_ids(ids)
+    else:
+        # Positional shard from before chunk ids: move the survivors into an id-mapped index.
+        old = store.index
+        keep = np.setdiff1d(np.arange(old.ntotal, dtype=np.int64), ids)
+        vectors = old.reconstruct_n(0, old.ntotal)[keep]
+        index = _new_index(old.d, len(keep))
+        if not index.is_trained:
+            index.train(vectors)
+        _tune(index)
+        index.add_with_ids(vectors, keep)
+        store.index = index
+    for chunk_id in chunk_ids:
+        store.docstore.delete([store.index_to_docstore_id.pop(chunk_id)])
+
+
+def remove_document(user_id: str, doc_id: str, embeddings: Any) -> None:
+    """Drop one upload's chunks from the shard and BM25 corpus; nothing is re-embedded or re-tokenized."""
+    store = load_faiss(user_id, embeddings)
+    if store is not None:
+        chunk_ids = [
+            chunk_id for chunk_id, ds_id in store.index_to_docstore_id.items()
+            if store.docstore.search(ds_id).metadata.get("doc_id") == doc_id
+        ]
+        if len(chunk_ids) == store.index.ntotal:
+            drop_faiss(user_id)
+        elif chunk_ids:
+            _remove_vectors(store, chunk_ids)
+            save_faiss(user_id, store)
+
+    corpus = load_bm25_corpus(user_id)
+    keep = np.fromiter((d.metadata.get("doc_id") != doc_id for d in corpus), dtype=bool, count=len(corpus))
+    if not keep.all():
+        index = load_bm25_index(user_id, corpus)
+        write_bm25_corpus(user_id, [d for d, k in zip(corpus, keep.tolist()) if k], index.remove(keep))
+
+
+def drop_faiss(user_id: str) -> None:
+    _stores.pop(user_id, None)
+    shutil.rmtree(faiss_path(user_id), ignore_errors=True)
+
+
+def _write_docs(f, docs: List[Document]) -> None:
+    # Record by record through the file's buffer, so a rewrite never holds a second,
+    # serialized copy of the whole corpus in memory.
+    pack = msgpack.Packer().pack
+    for d in docs:
+        f.write(pack({"t": d.page_content, "m": d.metadata}))
+
+
+def _file_size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return -1
+
+
+def _migrate_legacy_bm25(user_id: str) -> None:
+    legacy = os.path.join(user_dir(user_id), "bm25_corpus.pkl")
+    if os.path.exists(legacy) and not os.path.exists(bm25_path(user_id)):
+        with open(legacy, "rb") as f:
+            write_bm25_corpus(user_id, pickle.load(f))
+        os.remove(legacy)
+
+
+# Repeated per chunk of an upload; msgpack decodes a fresh str for each record.
+_INTERNED_FIELDS = ("doc_id", "source", "section")
+
+
+def load_bm25_corpus(user_id: str) -> List[Document]:
+    _migrate_legacy_bm25(user_id)
+    path = bm25_path(user_id)
+    size = _file_size(path)
+    cached = _corpora.get(user_id)
+    if cached and cached[0] == size:
+        return cached[1]
+    docs: List[Document] = []
+    if size > 0:
+        with open(path, "rb") as f:
+            for rec in msgpack.Unpacker(f, raw=False):
+                meta = rec["m"]
+                for field in _INTERNED_FIELDS:
+                    value = meta.get(field)
+                    if isinstance(value, str):
+                        meta[field] = sys.intern(value)
+                docs.append(Document(page_content=rec["t"], metadata=meta))
+    _corpora[user_id] = (size, docs)
+    return docs
+
+
+def append_bm25_corpus(user_id: str, docs: List[Document]) -> None:
+    """Append new chunks without rewriting the existing corpus."""
+    corpus = load_bm25_corpus(user_id)
+    index = load_bm25_index(user_id, corpus)
+    path = bm25_path(user_id)
+    with open(path, "ab") as f:
+        _write_docs(f, docs)
+    size = _file_size(path)
+    _corpora[user_id] = (size, corpus + docs)
+    _store_bm25_index(user_id, size, index.extend([d.page_content for d in docs]))
+
+
+def write_bm25_corpus(user_id: str, docs: List[Document], index: Optional[BM25Index] = None) -> None:
+    """Rewrite the corpus; `index`, when given, must already describe `docs`."""
+    path = bm25_path(user_id)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        _write_docs(f, docs)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    size = _file_size(path)
+    _corpora[user_id] = (size, list(docs))
+    if index is None:
+        index = BM25Index.build([d.page_content for d in docs])
+    _store_bm25_index(user_id, size, index)
+
+
+def _store_bm25_index(user_id: str, size: int, index: BM25Index) -> None:
+    save_index(index, bm25_index_path(user_id))
+    _bm25_indexes[user_id] = (size, index)
+
+
+def _index_is_current(user_id: str, index: Optional[BM25Index], n_docs: int) -> bool:
+    """An on-disk index matches the corpus if it was written after it and covers every chunk."""
+    if index is None or index.n_docs != n_docs:
+        return False
+    try:
+        return os.stat(bm25_index_path(user_id)).st_mtime_ns >= os.stat(bm25_path(user_id)).st_mtime_ns
+    except FileNotFoundError:
+        return n_docs == 0
+
+
+def load_bm25_index(user_id: str, corpus: List[Document]) -> BM25Index:
+    """Index for `corpus`; built from scratch (and persisted) when missing or out of step.
+
+    `corpus` must come from load_bm25_corpus, whose file size keys this cache the same
+    way it keys _corpora, so a rewrite by another worker is noticed even when the
+    chunk count comes out unchanged.
+    """
+    entry = _corpora.get(user_id)
+    size = entry[0] if entry and entry[1] is corpus else _file_size(bm25_path(user_id))
+    cached = _bm25_indexes.get(user_id)
+    if cached and cached[0] == size and cached[1].n_docs == len(corpus):
+        return cached[1]
+    index = load_index(bm25_index_path(user_id))
+    if not _index_is_current(user_id, index, len(corpus)):
+        index = BM25Index.build([d.page_content for d in corpus])
+        save_index(index, bm25_index_path(user_id))
+    _bm25_indexes[user_id] = (size, index)
+    return index
@@ -1,9 +1,20 @@
+import asyncio
 import aiosqlite
 import os
-from typing import Any, List, Optional
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 
 from app.config import settings
 
+_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+)
+
 
 async def get_db() -> aiosqlite.Connection:
     os.makedirs(os.path.dirname(settings.db_path) or ".", exist_ok=True)
@@ -12,12 +23,86 @@ async def get_db() -> aiosqlite.Connection:
     return conn
 
 
+class ConnectionPool:
+    """Long-lived aiosqlite connections shared across requests.
+
+    PRAGMAs are applied once per connection when it is opened, so the hot path
+    only pays for the query itself.
+    """
+
+    def __init__(self, min_size: int = 1, max_size: int = 4) -> None:
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self._idle: asyncio.Queue = asyncio.Queue()
+        self._all: List[aiosqlite.Connection] = []
+        self._grow_lock = asyncio.Lock()
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await get_db()
+        for pragma in _PRAGMAS:
+            await conn.execute(pragma)
+        self._all.append(conn)
+        return conn
+
+    async def open(self) -> None:
+        for _ in range(self.min_size - len(self._all)):
+            self._idle.put_nowait(await self._connect())
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[aiosqlite.Connection]:
+        if self._idle.empty() and len(self._all) < self.max_size:
+            async with self._grow_lock:
+                if self._idle.empty() and len(self._all) < self.max_size:
+                    self._idle.put_nowait(await self._connect())
+        conn = await self._idle.get()
+        try:
+            yield conn
+        except BaseException:
+            # A failed write leaves its implicit transaction (and the write lock) open;
+            # the next borrower's commit would otherwise persist the partial rows.
+            await conn.rollback()
+            raise
+        else:
+            if conn.in_transaction:
+                await conn.rollback()
+        finally:
+            self._idle.put_nowait(conn)
+
+    async def close(self) -> None:
+        while self._all:
+            await self._all.pop().close()
+        self._idle = asyncio.Queue()
+
+
+_pool: Optional[ConnectionPool] = None
+_pool_lock = asyncio.Lock()
+
+
+async def get_pool() -> ConnectionPool:
+    global _pool
+    if _pool is None:
+        async with _pool_lock:
+            if _pool is None:
+                pool = ConnectionPool(settings.db_pool_min_size, settings.db_pool_max_size)
+                await pool.open()
+                _pool = pool
+    return _pool
+
+
+async def close_pool() -> None:
+    global _pool
+    if _pool is not None:
+        await _pool.close()
+        _pool = None
+
+
 async def init_schema(conn: aiosqlite.Connection) -> None:
     await conn.executescript("""
         CREATE TABLE IF NOT EXISTS users (
             id TEXT PRIMARY KEY,
             username TEXT UNIQUE NOT NULL,
             password_hash TEXT NOT NULL,
+            password_salt TEXT,
             created_at INTEGER NOT NULL
         );
 
@@ -50,20 +135,35 @@ async def init_schema(conn: aiosqlite.Connection) -> None:
         CREATE INDEX IF NOT EXISTS idx_chunks_doc ON chunks(doc_id);
         CREATE INDEX IF NOT EXISTS idx_chunks_parent ON chunks(user_id, doc_id, parent_idx);
     """)
+    cursor = await conn.execute("PRAGMA table_info(users)")
+    columns = {row[1] for row in await cursor.fetchall()}
+    if "password_salt" not in columns:
+        await conn.execute("ALTER TABLE users ADD COLUMN password_salt TEXT")
+        await conn.commit()
 
 
-async def create_user(conn: aiosqlite.Connection, user_id: str, username: str, password_hash: str) -> None:
+async def create_user(
+    conn: aiosqlite.Connection, user_id: str, username: str, password_hash: str, password_salt: str
+) -> None:
     import time
     await conn.execute(
-        "INSERT INTO users (id, username, password_hash, created_at) VALUES (?, ?, ?, ?)",
-        (user_id, username, password_hash, int(time.time())),
+        "INSERT INTO users (id, username, password_hash, password_salt, created_at) VALUES (?, ?, ?, ?, ?)",
+        (user_id, username, password_hash, password_salt, int(time.time())),
+    )
+    await conn.commit()
+
+
+async def update_user_password(conn: aiosqlite.Connection, user_id: str, password_hash: str, password_salt: str) -> None:
+    await conn.execute(
+        "UPDATE users SET password_hash = ?, password_salt = ? WHERE id = ?",
+        (password_hash, password_salt, user_id),
     )
     await conn.commit()
 
 
 async def get_user_by_username(conn: aiosqlite.Connection, username: str) -> Optional[dict]:
     cursor = await conn.execute(
-        "SELECT id, username, password_hash FROM users WHERE username = ?",
+        "SELECT id, username, password_hash, password_salt FROM users WHERE username = ?",
         (username,),
     )
     row = await cursor.fetchone()
@@ -91,38 +191,82 @@ async def insert_document(conn: aiosqlite.Connection, doc_id: str, user_id: str,
 async def insert_chunks(conn: aiosqlite.Connection, chunks: List[dict]) -> None:
     import time
     now = int(time.time())
-    for c in chunks:
-        await conn.execute(
-            """INSERT INTO chunks (id, doc_id, user_id, parent_idx, child_idx, parent_text, child_text, source, page, section, created_at)
-               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (
-                c["id"],
-                c["doc_id"],
-                c["user_id"],
-                c["parent_idx"],
-                c["child_idx"],
-                c["parent_text"],
-                c["child_text"],
-                c["source"],
-                c.get("page"),
-                c.get("section"),
-                now,
-            ),
+    rows = [
+        (
+            c["id"],
+            c["doc_id"],
+            c["user_id"],
+            c["parent_idx"],
+            c["child_idx"],
+            c["parent_text"],
+            c["child_text"],
+            c["source"],
+            c.get("page"),
+            c.get("section"),
+            now,
         )
+        for c in chunks
+    ]
+    # One worker-thread hop and one implicit transaction for the whole upload.
+    await conn.executemany(
+        """INSERT INTO chunks (id, doc_id, user_id, parent_idx, child_idx, parent_text, child_text, source, page, section, created_at)
+           VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+        rows,
+    )
     await conn.commit()
+    for user_id in {c["user_id"] for c in chunks}:
+        _invalidate_chunk_caches(user_id)
 
 
-async def get_parent_texts(conn: aiosqlite.Connection, user_id: str, parent_keys: List[tuple]) -> List[str]:
-    results = []
-    for doc_id, parent_idx in parent_keys:
-        cursor = await conn.execute(
-            "SELECT parent_text FROM chunks WHERE user_id = ? AND doc_id = ? AND parent_idx = ? LIMIT 1",
-            (user_id, doc_id, parent_idx),
-        )
-        row = await cursor.fetchone()
-        if row:
-            results.append(row["parent_text"])
-    return results
+ParentMap = Dict[Tuple[str, int], str]
+Stamp = Optional[Tuple[int, int]]
+
+# Per-user parent paragraphs (LRU over users) and chunk counts, each stored with the
+# vectorstore index_stamp it was loaded under. Writes through insert_chunks /
+# delete_document_chunks invalidate this process directly; other workers see the
+# shard stamp move and reload. The generation check stops a load that raced with a
+# local write from caching stale rows.
+_parent_maps: "OrderedDict[str, Tuple[Stamp, ParentMap]]" = OrderedDict()
+_chunk_counts: Dict[str, Tuple[Stamp, int]] = {}
+_chunk_gens: Dict[str, int] = {}
+
+
+def _invalidate_chunk_caches(user_id: str) -> None:
+    _parent_maps.pop(user_id, None)
+    _chunk_counts.pop(user_id, None)
+    _chunk_gens[user_id] = _chunk_gens.get(user_id, 0) + 1
+
+
+def cached_parent_map(user_id: str, stamp: Stamp = None) -> Optional[ParentMap]:
+    cached = _parent_maps.get(user_id)
+    if cached is None or cached[0] != stamp:
+        return None
+    _parent_maps.move_to_end(user_id)
+    return cached[1]
+
+
+async def get_parent_map(
+    conn: aiosqlite.Connection, user_id: str, stamp: Stamp = None, refresh: bool = False
+) -> ParentMap:
+    """Every (doc_id, parent_idx) -> parent_text for a user, cached per index stamp.
+
+    refresh=True skips the cached map, for callers that found a key missing from it.
+    """
+    parents = None if refresh else cached_parent_map(user_id, stamp)
+    if parents is not None:
+        return parents
+    gen = _chunk_gens.get(user_id, 0)
+    cursor = await conn.execute(
+        "SELECT doc_id, parent_idx, parent_text FROM chunks WHERE user_id = ? GROUP BY doc_id, parent_idx",
+        (user_id,),
+    )
+    parents = {(r["doc_id"], r["parent_idx"]): r["parent_text"] for r in await cursor.fetchall()}
+    if _chunk_gens.get(user_id, 0) == gen:
+        _parent_maps[user_id] = (stamp, parents)
+        _parent_maps.move_to_end(user_id)
+        while len(_parent_maps) > settings.parent_cache_users:
+            _parent_maps.popitem(last=False)
+    return parents
 
 
 async def get_documents_for_user(conn: aiosqlite.Connection, user_id: str) -> List[dict]:
@@ -138,10 +282,27 @@ async def delete_document_chunks(conn: aiosqlite.Connection, user_id: str, doc_i
     cursor = await conn.execute("DELETE FROM chunks WHERE user_id = ? AND doc_id = ?", (user_id, doc_id))
     await conn.execute("DELETE FROM documents WHERE id = ? AND user_id = ?", (doc_id, user_id))
     await conn.commit()
+    _invalidate_chunk_caches(user_id)
     return cursor.rowcount
 
 
-async def get_chunk_count_for_user(conn: aiosqlite.Connection, user_id: str) -> int:
+def cached_chunk_count(user_id: str, stamp: Stamp = None) -> Optional[int]:
+    cached = _chunk_counts.get(user_id)
+    if cached is None or cached[0] != stamp:
+        return None
+    return cached[1]
+
+
+async def get_chunk_count_for_user(conn: aiosqlite.Connection, user_id: str, stamp: Stamp = None) -> int:
+    count = cached_chunk_count(user_id, stamp)
+    if count is not None:
+        return count
+    gen = _chunk_gens.get(user_id, 0)
     cursor = await conn.execute("SELECT COUNT(*) as n FROM chunks WHERE user_id = ?", (user_id,))
     row = await cursor.fetchone()
-    return row["n"] if row else 0
+    count = row["n"] if row else 0
+    # Ingest writes the shard before the chunk rows, so a zero seen under a new stamp
+    # may be an upload still in flight; only cache counts that can't gate /ask shut.
+    if count and _chunk_gens.get(user_id, 0) == gen:
+        _chunk_counts[user_id] = (stamp, count)
+    return count
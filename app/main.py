@@ -7,15 +7,14 @@ if "PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION" not in os.environ:
     os.environ["PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION"] = "python"
 
 import asyncio
-import json
 import logging
-import pickle
 import shutil
-import tempfile
 import uuid
+import weakref
 from contextlib import asynccontextmanager
 
 import aiofiles
+import orjson
 from typing import Optional
 from fastapi import Depends, FastAPI, File, HTTPException, Request, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
@@ -28,24 +27,40 @@ from app.auth.middleware import get_current_user, get_optional_user, get_user_fr
 from app.auth.router import router as auth_router
 from app.config import settings
 from app.core.cache import query_cache
-from app.core.ingest import ingest_document
-from app.core.memory import extract_and_store_memory
-from app.core.retriever import ask_stream
+from app.core.embeddings import close_client as close_embedding_client
+from app.core.graph import aget_graph, checkpoint_pending, graph_snapshot, load_graph_store
+from app.core.ingest import _get_embeddings, ingest_document
+from app.core.memory import schedule_memory_extraction
+from app.core.retriever import ask_stream, warm_up
 from app.core.sandbox import get_agent_executor
-from app.db import delete_document_chunks, get_chunk_count_for_user, get_db, get_documents_for_user, init_schema
+from app.core.vectorstore import index_stamp, remove_document
+from app.db import cached_chunk_count, close_pool, delete_document_chunks, get_chunk_count_for_user, get_documents_for_user, get_pool, init_schema
 from app.schemas import AnalyzeRequest, AnalyzeResponse
 
 logger = logging.getLogger(__name__)
 VERSION = "3.0"
 MAX_MB = settings.max_upload_mb
 SUPPORTED = set(settings.supported_types.split(","))
-user_locks: dict[str, asyncio.Lock] = {}
+# Weak values: a user's lock lives only while an upload/delete holds or awaits it, so
+# the map doesn't grow with every user ever seen. Lookup and insert have no await in
+# between, so the event loop can't interleave two callers here.
+user_locks: "weakref.WeakValueDictionary[str, asyncio.Lock]" = weakref.WeakValueDictionary()
 
 
 def _get_user_lock(user_id: str) -> asyncio.Lock:
-    if user_id not in user_locks:
-        user_locks[user_id] = asyncio.Lock()
-    return user_locks[user_id]
+    lock = user_locks.get(user_id)
+    if lock is None:
+        lock = user_locks[user_id] = asyncio.Lock()
+    return lock
+
+
+_SSE_OPTS = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+_SSE_DONE = b"data: [DONE]\n\n"
+
+
+def _sse(obj) -> bytes:
+    """One SSE frame; orjson emits UTF-8 bytes directly, so there is no str -> bytes re-encode."""
+    return b"data: %b\n\n" % orjson.dumps(obj, option=_SSE_OPTS)
 
 
 @asynccontextmanager
@@ -54,37 +69,36 @@ async def lifespan(app):
     os.makedirs("vectorstore", exist_ok=True)
     os.makedirs("memory", exist_ok=True)
     os.makedirs("artifacts", exist_ok=True)
-    conn = await get_db()
-    try:
+    pool = await get_pool()
+    async with pool.acquire() as conn:
         await init_schema(conn)
-    finally:
-        await conn.close()
-
-    app.state.graph_store = {}
-    for name in os.listdir("vectorstore"):
-        if name.startswith("user_") and os.path.isdir(os.path.join("vectorstore", name)):
-            graph_path = os.path.join("vectorstore", name, "knowledge_graph.pkl")
-            if os.path.exists(graph_path):
-                try:
-                    with open(graph_path, "rb") as f:
-                        import pickle
-                        G = pickle.load(f)
-                    user_id = name.replace("user_", "")
-                    app.state.graph_store[user_id] = G
-                except Exception:
-                    pass
+
+    # Graphs load per user on first access, so startup doesn't scale with user count.
+    app.state.graph_store = load_graph_store()
 
     app.state.reranker = None
     if not settings.sanity_mock:
         try:
-            from langchain_community.cross_encoders import HuggingFaceCrossEncoder
-            app.state.reranker = HuggingFaceCrossEncoder(model_name="cross-encoder/ms-marco-MiniLM-L-6-v2")
+            from app.core.rerank import RerankBatcher, load_reranker
+            app.state.reranker = RerankBatcher(
+                await asyncio.to_thread(load_reranker),
+                max_requests=settings.reranker_batch_requests,
+                window=settings.reranker_batch_window_ms / 1000,
+            )
+            app.state.reranker.start()
         except Exception as e:
             logger.warning("Cross-encoder not loaded: %s", e)
 
+    # Model loading runs in the background so startup isn't gated on Ollama.
+    warmup = asyncio.create_task(warm_up())
+
     yield
-    for lock in user_locks.values():
-        pass
+    warmup.cancel()
+    if app.state.reranker is not None:
+        await app.state.reranker.close()
+    await asyncio.to_thread(checkpoint_pending, app.state.graph_store)
+    await close_embedding_client()
+    await close_pool()
 
 
 app = FastAPI(title="Agentic RAG Chatbot", version=VERSION, lifespan=lifespan)
@@ -137,11 +151,14 @@ async def ask_stream_route(
         raise HTTPException(status_code=400, detail="Empty query")
 
     user_id = user["id"]
-    conn = await get_db()
-    try:
-        count = await get_chunk_count_for_user(conn, user_id)
-    finally:
-        await conn.close()
+    # Counts are cached per index stamp, so this is usually a stat and a dict hit; an
+    # upload or delete in any worker moves the stamp and forces a recount.
+    stamp = index_stamp(user_id)
+    count = cached_chunk_count(user_id, stamp)
+    if count is None:
+        pool = await get_pool()
+        async with pool.acquire() as conn:
+            count = await get_chunk_count_for_user(conn, user_id, stamp)
 
     if count == 0:
         raise HTTPException(status_code=503, detail={"error": "No documents indexed yet", "action": "upload_first"})
@@ -151,7 +168,8 @@ async def ask_stream_route(
 
     async def event_gen():
         try:
-            result = await ask_stream(
+            answer = ""
+            async for event in ask_stream(
                 user_id,
                 query,
                 filter_source=filter_source,
@@ -159,20 +177,18 @@ async def ask_stream_route(
                 filter_page=filter_page,
                 graph_store=graph_store,
                 reranker_model=reranker,
-            )
-            if result.get("cached"):
-                yield f"data: {json.dumps({'type': 'cached', 'answer': result['answer'], 'citations': result['citations']})}\n\n"
-                mem = await extract_and_store_memory(user_id, query, result["answer"])
-                yield f"data: {json.dumps({'type': 'memory', 'data': mem})}\n\n"
-            else:
-                yield f"data: {json.dumps({'type': 'token', 'text': result['answer']})}\n\n"
-                yield f"data: {json.dumps({'type': 'citations', 'data': result['citations']})}\n\n"
-                mem = await extract_and_store_memory(user_id, query, result["answer"])
-                yield f"data: {json.dumps({'type': 'memory', 'data': mem})}\n\n"
+            ):
+                if event["type"] == "token":
+                    answer += event["text"]
+                elif event["type"] == "cached":
+                    answer = event["answer"]
+                yield _sse(event)
+            # The memory judge runs in the background, so [DONE] isn't held for an LLM call.
+            yield _sse({"type": "memory", "data": schedule_memory_extraction(user_id, query, answer)})
         except Exception as e:
             logger.exception("Ask failed: %s", e)
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)[:200]})}\n\n"
-        yield "data: [DONE]\n\n"
+            yield _sse({"type": "error", "message": str(e)[:200]})
+        yield _SSE_DONE
 
     return StreamingResponse(
         event_gen(),
@@ -195,22 +211,21 @@ async def upload(
         )
 
     job_id = str(uuid.uuid4())
-    temp_path = None
     try:
-        with tempfile.NamedTemporaryFile(delete=False, suffix=ext) as tmp:
-            temp_path = tmp.name
-            size = 0
-            while chunk := await file.read(8192):
-                size += len(chunk)
-                if size > MAX_MB * 1024 * 1024:
-                    os.remove(temp_path)
-                    raise HTTPException(status_code=413, detail={"error": f"File too large (max {MAX_MB}MB)"})
-                tmp.write(chunk)
+        # Uploads are capped at MAX_MB, so they are parsed from memory rather than
+        # copied out to a second temp file and read back.
+        parts = []
+        size = 0
+        while part := await file.read(1 << 20):
+            size += len(part)
+            if size > MAX_MB * 1024 * 1024:
+                raise HTTPException(status_code=413, detail={"error": f"File too large (max {MAX_MB}MB)"})
+            parts.append(part)
 
         lock = _get_user_lock(user["id"])
         async with lock:
             graph_store = getattr(request.app.state, "graph_store", {})
-            result = await ingest_document(user["id"], temp_path, file.filename, graph_store=graph_store)
+            result = await ingest_document(user["id"], b"".join(parts), file.filename, graph_store=graph_store)
         await query_cache.invalidate_user(user["id"])
         return {"job_id": job_id, "doc_id": result["doc_id"], "filename": result["filename"], "chunks": result["chunks"]}
     except HTTPException:
@@ -218,53 +233,26 @@ async def upload(
     except Exception as e:
         logger.exception("Upload failed: %s", e)
         raise HTTPException(status_code=500, detail={"error": str(e)[:200]})
-    finally:
-        if temp_path and os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except OSError:
-                pass
 
 
 @app.get("/documents")
 async def list_docs(user=Depends(get_current_user)):
-    conn = await get_db()
-    try:
-        docs = await get_documents_for_user(conn, user["id"])
-        return docs
-    finally:
-        await conn.close()
+    pool = await get_pool()
+    async with pool.acquire() as conn:
+        return await get_documents_for_user(conn, user["id"])
 
 
 @app.delete("/documents/{doc_id}")
 async def delete_doc(doc_id: str, user=Depends(get_current_user)):
-    conn = await get_db()
-    try:
+    pool = await get_pool()
+    async with pool.acquire() as conn:
         n = await delete_document_chunks(conn, user["id"], doc_id)
-        if n == 0:
-            raise HTTPException(status_code=404, detail="Document not found")
-        await query_cache.invalidate_user(user["id"])
-        faiss_dir = f"vectorstore/user_{user['id']}"
-        bm25_path = os.path.join(faiss_dir, "bm25_corpus.pkl")
-        if os.path.exists(bm25_path):
-            async with aiofiles.open(bm25_path, "rb") as f:
-                chunks = pickle.loads(await f.read())
-            remaining = [c for c in chunks if c.metadata.get("doc_id") != doc_id]
-            async with aiofiles.open(bm25_path, "wb") as f:
-                await f.write(pickle.dumps(remaining))
-            if not remaining:
-                for p in [faiss_dir + "/faiss_index", faiss_dir + "/faiss_index.pkl"]:
-                    if os.path.exists(p):
-                        os.remove(p)
-            else:
-                from langchain_community.vectorstores import FAISS
-                from langchain_ollama import OllamaEmbeddings
-                emb = OllamaEmbeddings(model=settings.ollama_embed_model, base_url=settings.ollama_base_url)
-                store = await asyncio.to_thread(FAISS.from_documents, remaining, emb)
-                await asyncio.to_thread(store.save_local, os.path.join(faiss_dir, "faiss_index"))
-        return {"status": "deleted", "doc_id": doc_id}
-    finally:
-        await conn.close()
+    if n == 0:
+        raise HTTPException(status_code=404, detail="Document not found")
+    await query_cache.invalidate_user(user["id"])
+    async with _get_user_lock(user["id"]):
+        await asyncio.to_thread(remove_document, user["id"], doc_id, _get_embeddings())
+    return {"status": "deleted", "doc_id": doc_id}
 
 
 @app.get("/memory")
@@ -305,28 +293,16 @@ async def delete_memory(target: str, user=Depends(get_current_user)):
 @app.get("/graph/entities")
 async def graph_entities(request: Request, user=Depends(get_current_user)):
     graph_store = getattr(request.app.state, "graph_store", {})
-    G = graph_store.get(user["id"])
+    G = await aget_graph(graph_store, user["id"])
     if not G or G.number_of_nodes() == 0:
         return []
-    entities = []
-    for node in G.nodes():
-        data = G.nodes[node]
-        degree = G.degree(node)
-        entities.append({
-            "id": node,
-            "label": data.get("label", node),
-            "type": data.get("type", "concept"),
-            "doc_sources": list(set(data.get("doc_sources", []))),
-            "degree": degree,
-        })
-    entities.sort(key=lambda e: e["degree"], reverse=True)
-    return entities
+    return graph_snapshot(user["id"], G).entities
 
 
 @app.get("/graph/neighbors/{entity_id:path}")
 async def graph_neighbors(request: Request, entity_id: str, user=Depends(get_current_user)):
     graph_store = getattr(request.app.state, "graph_store", {})
-    G = graph_store.get(user["id"])
+    G = await aget_graph(graph_store, user["id"])
     if not G or not G.has_node(entity_id):
         return []
     neighbors = []
@@ -347,43 +323,25 @@ async def graph_neighbors(request: Request, entity_id: str, user=Depends(get_cur
 async def graph_full(request: Request, user=Depends(get_current_user)):
     """Returns nodes and edges for D3 force-directed graph."""
     graph_store = getattr(request.app.state, "graph_store", {})
-    G = graph_store.get(user["id"])
+    G = await aget_graph(graph_store, user["id"])
     if not G or G.number_of_nodes() == 0:
         return {"nodes": [], "edges": []}
-    nodes = []
-    for n in G.nodes():
-        d = G.nodes[n]
-        nodes.append({
-            "id": n,
-            "label": d.get("label", n),
-            "type": d.get("type", "concept"),
-            "degree": G.degree(n),
-        })
-    edges = []
-    seen = set()
-    for u, v, data in G.edges(data=True):
-        key = (min(u, v), max(u, v))
-        if key not in seen:
-            seen.add(key)
-            edges.append({
-                "source": u,
-                "target": v,
-                "relation": data.get("relation", "related_to"),
-                "weight": data.get("weight", 1),
-            })
-    return {"nodes": nodes, "edges": edges}
+    snapshot = graph_snapshot(user["id"], G)
+    return {"nodes": snapshot.nodes, "edges": snapshot.edges}
 
 
 @app.get("/graph/stats")
 async def graph_stats(request: Request, user=Depends(get_current_user)):
     graph_store = getattr(request.app.state, "graph_store", {})
-    G = graph_store.get(user["id"])
+    G = await aget_graph(graph_store, user["id"])
     if not G or G.number_of_nodes() == 0:
         return {"nodes": 0, "edges": 0, "density": 0.0, "top_entities": []}
     n, m = G.number_of_nodes(), G.number_of_edges()
     density = (2 * m) / (n * (n - 1)) if n > 1 else 0.0
-    top = sorted(G.nodes(), key=lambda x: G.degree(x), reverse=True)[:10]
-    top_entities = [{"id": x, "label": G.nodes[x].get("label", x), "degree": G.degree(x)} for x in top]
+    top_entities = [
+        {"id": e["id"], "label": e["label"], "degree": e["degree"]}
+        for e in graph_snapshot(user["id"], G).entities[:10]
+    ]
     return {"nodes": n, "edges": m, "density": round(density, 4), "top_entities": top_entities}
 
 
@@ -391,7 +349,7 @@ async def graph_stats(request: Request, user=Depends(get_current_user)):
 async def analyze(req: AnalyzeRequest, user=Depends(get_current_user)):
     try:
         agent = get_agent_executor()
-        out = agent.invoke({"input": req.request})
+        out = await asyncio.to_thread(agent.invoke, {"input": req.request})
         return AnalyzeResponse(result=out.get("output", str(out)))
     except Exception as e:
         logger.exception("Analyze failed: %s", e)
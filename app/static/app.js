@@ -163,6 +163,8 @@ async function fetchDocs() {
     });
 }
 
+const MEMORY_POLL_MS = [2000, 5000, 10000];
+
 async function fetchMemory() {
     const r = await api("GET", "/memory");
     if (!r.ok) return;
@@ -360,7 +362,12 @@ async function sendMessage() {
                     contentEl.parentElement.appendChild(det);
                 }
             } else if (msg.type === "memory") {
-                if (msg.data?.written) fetchMemory();
+                if (msg.data?.written) {
+                    fetchMemory();
+                } else if (msg.data?.queued) {
+                    // The memory judge finishes after [DONE]; re-read the panel once its write can land.
+                    MEMORY_POLL_MS.forEach((ms) => setTimeout(fetchMemory, ms));
+                }
             } else if (msg.type === "error") {
                 contentEl.textContent = msg.message || "Error";
             }
@@ -10,6 +10,8 @@ interface Message {
   timestamp: Date
 }
 
+const MEMORY_POLL_MS = [2000, 5000, 10000]
+
 interface ChatWindowProps {
   token: string
   memoryEnabled: boolean
@@ -25,6 +27,9 @@ export function ChatWindow({ token, memoryEnabled, onMemoryToggle, onToast, onMe
   const [streamingContent, setStreamingContent] = useState('')
   const [streamingCitations, setStreamingCitations] = useState<Citation[]>([])
   const scrollRef = useRef<HTMLDivElement>(null)
+  const memoryTimers = useRef<number[]>([])
+
+  useEffect(() => () => memoryTimers.current.forEach(clearTimeout), [])
 
   useEffect(() => {
     scrollRef.current?.scrollTo({ top: scrollRef.current.scrollHeight, behavior: 'smooth' })
@@ -107,7 +112,14 @@ export function ChatWindow({ token, memoryEnabled, onMemoryToggle, onToast, onMe
             citations = msg.data || []
             setStreamingCitations(citations)
           } else if (msg.type === 'memory') {
-            onMemoryUpdate?.()
+            if (msg.data?.written) {
+              onMemoryUpdate?.()
+            } else if (msg.data?.queued) {
+              // The memory judge finishes after [DONE]; re-read the panel once its write can land.
+              memoryTimers.current.push(
+                ...MEMORY_POLL_MS.map((ms) => window.setTimeout(() => onMemoryUpdate?.(), ms)),
+              )
+            }
           } else if (msg.type === 'error') {
             fullAnswer = msg.message || 'Error'
             setStreamingContent(fullAnswer)
@@ -61,7 +61,14 @@ async def run_mock() -> dict:
 
 
 async def run_live() -> dict:
-    import requests
+    import httpx
+    from urllib.parse import quote
+
+    try:
+        import h2  # noqa: F401
+        http2 = True
+    except ImportError:
+        http2 = False
 
     Path(SAMPLE_DOC).parent.mkdir(parents=True, exist_ok=True)
     if not Path(SAMPLE_DOC).exists():
@@ -69,54 +76,56 @@ async def run_live() -> dict:
 
     t0 = time.time()
 
-    # 1. Register
-    print("  [1/5] Registering...")
-    try:
-        r = requests.post(f"{BASE}/users/register", json={"username": "sanity_user", "password": "sanity_pass"}, timeout=10)
-    except requests.RequestException as e:
-        fail(f"Server not reachable: {e}. Run 'make run' first.")
-    if r.status_code != 200:
-        fail(f"Register failed: {r.text}")
-    data = r.json()
-    token = data.get("access_token")
-    check(token, "Got access token")
-
-    # 2. Upload
-    print("  [2/5] Uploading...")
-    with open(SAMPLE_DOC, "rb") as f:
-        r = requests.post(f"{BASE}/upload", files={"file": ("sample.txt", f)}, headers={"Authorization": f"Bearer {token}"}, timeout=60)
-    if r.status_code != 200:
-        fail(f"Upload failed: {r.text}")
-    data = r.json()
-    chunks = data.get("chunks", 0)
-    check(chunks >= 1, f"Indexed {chunks} chunks")
-
-    # 3. Ask (SSE)
-    print("  [3/5] Asking...")
-    from urllib.parse import quote
-    url = f"{BASE}/ask?query={quote(TEST_QUESTION)}&token={quote(token)}"
-    r = requests.get(url, headers={"Accept": "text/event-stream"}, stream=True, timeout=90)
-    if r.status_code != 200:
-        fail(f"Ask failed: {r.text}")
-    raw = r.text
-    answer = ""
-    citations = []
-    for line in raw.strip().split("\n"):
-        if line.startswith("data: "):
-            data_str = line[6:]
-            if data_str == "[DONE]":
-                break
-            try:
-                msg = json.loads(data_str)
-                if msg.get("type") == "token":
-                    answer += msg.get("text", "")
-                elif msg.get("type") == "cached":
-                    answer = msg.get("answer", "")
-                    citations = msg.get("citations", [])
-                elif msg.get("type") == "citations":
-                    citations = msg.get("data", [])
-            except json.JSONDecodeError:
-                pass
+    # One keep-alive client for register, upload and ask.
+    async with httpx.AsyncClient(base_url=BASE, http2=http2, timeout=90) as client:
+        # 1. Register
+        print("  [1/5] Registering...")
+        try:
+            r = await client.post("/users/register", json={"username": "sanity_user", "password": "sanity_pass"}, timeout=10)
+        except httpx.HTTPError as e:
+            fail(f"Server not reachable: {e}. Run 'make run' first.")
+        if r.status_code != 200:
+            fail(f"Register failed: {r.text}")
+        data = r.json()
+        token = data.get("access_token")
+        check(token, "Got access token")
+
+        # 2. Upload
+        print("  [2/5] Uploading...")
+        with open(SAMPLE_DOC, "rb") as f:
+            r = await client.post("/upload", files={"file": ("sample.txt", f)}, headers={"Authorization": f"Bearer {token}"}, timeout=60)
+        if r.status_code != 200:
+            fail(f"Upload failed: {r.text}")
+        data = r.json()
+        chunks = data.get("chunks", 0)
+        check(chunks >= 1, f"Indexed {chunks} chunks")
+
+        # 3. Ask (SSE), parsed line by line as events arrive
+        print("  [3/5] Asking...")
+        url = f"/ask?query={quote(TEST_QUESTION)}&token={quote(token)}"
+        answer = ""
+        citations = []
+        async with client.stream("GET", url, headers={"Accept": "text/event-stream"}) as r:
+            if r.status_code != 200:
+                await r.aread()
+                fail(f"Ask failed: {r.text}")
+            async for line in r.aiter_lines():
+                if not line.startswith("data: "):
+                    continue
+                data_str = line[6:]
+                if data_str == "[DONE]":
+                    break
+                try:
+                    msg = json.loads(data_str)
+                    if msg.get("type") == "token":
+                        answer += msg.get("text", "")
+                    elif msg.get("type") == "cached":
+                        answer = msg.get("answer", "")
+                        citations = msg.get("citations", [])
+                    elif msg.get("type") == "citations":
+                        citations = msg.get("data", [])
+                except json.JSONDecodeError:
+                    pass
 
     check(len(answer) > 0, "Answer non-empty")
     check(len(citations) >= 1, f"Got {len(citations)} citations")
@@ -26,3 +26,23 @@ async def test_read_user_memory_empty():
     """When no memory file exists, returns empty string."""
     result = await read_user_memory("nonexistent-user-xyz-123")
     assert result == ""
+
+
+@pytest.mark.asyncio
+async def test_memory_judge_skipped_for_neutral_questions():
+    """Plain questions short-circuit; anything about the user is queued for the judge."""
+    import asyncio
+    from app.core import memory
+
+    assert memory.is_neutral_query("What is the GLUE benchmark?")
+    assert not memory.is_neutral_query("What should I read first as a finance analyst?")
+    assert not memory.is_neutral_query("I prefer weekly summaries on Mondays")
+
+    with patch("app.core.memory.settings") as mock_settings:
+        mock_settings.sanity_mock = True
+        mock_settings.memory_confidence_threshold = 0.8
+        assert memory.schedule_memory_extraction("user1", "how does HyDE work?", "...")["written"] is False
+        assert not memory._memory_tasks
+        result = memory.schedule_memory_extraction("user1", "I prefer weekly summaries", "Noted.")
+        assert result["queued"] is True
+        await asyncio.gather(*memory._memory_tasks)
@@ -1,4 +1,5 @@
 import pytest
+from contextlib import asynccontextmanager
 from unittest.mock import AsyncMock, MagicMock, patch
 from langchain_core.documents import Document
 from app.core.retriever import apply_metadata_filters, expand_to_parents
@@ -18,6 +19,17 @@ def make_doc(source="doc.pdf", section="Methods", page=3):
     )
 
 
+def make_pool(conn):
+    pool = MagicMock()
+
+    @asynccontextmanager
+    async def acquire():
+        yield conn
+
+    pool.acquire = acquire
+    return pool
+
+
 def test_filter_by_source():
     docs = [make_doc("paper1.pdf"), make_doc("paper2.pdf"), make_doc("paper1.pdf")]
     result = apply_metadata_filters(docs, filter_source="paper1.pdf")
@@ -48,6 +60,12 @@ def test_filter_no_match_returns_original():
     assert result == docs
 
 
+def test_filter_fallbacks_return_same_list_object():
+    docs = [make_doc("paper1.pdf"), make_doc("paper2.pdf")]
+    assert apply_metadata_filters(docs, filter_source="nonexistent.pdf") is docs
+    assert apply_metadata_filters(docs) is docs
+
+
 def test_filter_combined():
     docs = [
         make_doc("a.pdf", "Methods", 1),
@@ -84,17 +102,18 @@ async def test_expand_to_parents_deduplicates():
         ),
     ]
 
-    parent_texts = ["Parent text 0", "Parent text 1"]
-    conn = MagicMock()
-    conn.close = AsyncMock()
+    parent_map = {("d1", 0): "Parent text 0", ("d1", 1): "Parent text 1"}
 
-    with patch("app.core.retriever.get_db", new_callable=AsyncMock) as mock_get_db:
-        mock_get_db.return_value = conn
-        with patch("app.core.retriever.get_parent_texts", new_callable=AsyncMock) as mock_get:
-            mock_get.return_value = parent_texts
+    with patch("app.core.retriever.cached_parent_map", return_value=None), \
+            patch("app.core.retriever.get_pool", new_callable=AsyncMock) as mock_get_pool:
+        mock_get_pool.return_value = make_pool(MagicMock())
+        with patch("app.core.retriever.get_parent_map", new_callable=AsyncMock) as mock_get:
+            mock_get.return_value = parent_map
 
             result = await expand_to_parents("user1", children)
 
+    mock_get.assert_awaited_once()
+
     assert len(result) == 3
     assert result[0].page_content == "Parent text 0"
     assert result[1].page_content == "Parent text 0"
@@ -116,13 +135,11 @@ async def test_expand_to_parents_preserves_metadata():
         )
     ]
 
-    conn = MagicMock()
-    conn.close = AsyncMock()
-
-    with patch("app.core.retriever.get_db", new_callable=AsyncMock) as mock_get_db:
-        mock_get_db.return_value = conn
-        with patch("app.core.retriever.get_parent_texts", new_callable=AsyncMock) as mock_get:
-            mock_get.return_value = ["Full parent paragraph text here."]
+    with patch("app.core.retriever.cached_parent_map", return_value=None), \
+            patch("app.core.retriever.get_pool", new_callable=AsyncMock) as mock_get_pool:
+        mock_get_pool.return_value = make_pool(MagicMock())
+        with patch("app.core.retriever.get_parent_map", new_callable=AsyncMock) as mock_get:
+            mock_get.return_value = {("d1", 0): "Full parent paragraph text here."}
 
             result = await expand_to_parents("user1", children)
 
@@ -130,3 +147,183 @@ async def test_expand_to_parents_preserves_metadata():
     assert result[0].metadata["section"] == "Methods"
     assert result[0].metadata["page"] == 2
     assert result[0].page_content == "Full parent paragraph text here."
+
+
+@pytest.mark.asyncio
+async def test_expand_to_parents_reloads_on_cache_miss():
+    children = [Document(page_content="child", metadata={"doc_id": "d2", "parent_idx": 0})]
+
+    with patch("app.core.retriever.cached_parent_map", return_value={("d1", 0): "stale"}), \
+            patch("app.core.retriever.get_pool", new_callable=AsyncMock) as mock_get_pool:
+        mock_get_pool.return_value = make_pool(MagicMock())
+        with patch("app.core.retriever.get_parent_map", new_callable=AsyncMock) as mock_get:
+            mock_get.return_value = {("d2", 0): "Fresh parent"}
+
+            result = await expand_to_parents("user1", children)
+
+    assert mock_get.await_args.kwargs["refresh"] is True
+    assert result[0].page_content == "Fresh parent"
+
+
+@pytest.mark.asyncio
+async def test_ask_stream_sends_citations_before_tokens():
+    from langchain_core.language_models.fake_chat_models import FakeListChatModel
+    from app.core.retriever import ask_stream
+
+    async def events(found, entry=((1, 2), MagicMock())):
+        with patch("app.core.retriever._acquire_retriever", new_callable=AsyncMock, return_value=entry), \
+                patch("app.core.cache.query_cache.get", new_callable=AsyncMock, return_value=None), \
+                patch("app.core.cache.query_cache.set", new_callable=AsyncMock), \
+                patch("app.core.retriever.settings.semantic_cache_enabled", False), \
+                patch("app.core.retriever.read_user_memory", new_callable=AsyncMock, return_value=""), \
+                patch("app.core.retriever._hybrid_search", new_callable=AsyncMock, return_value=found), \
+                patch("app.core.retriever.expand_to_parents", new_callable=AsyncMock, return_value=found), \
+                patch("app.core.retriever._get_llm", return_value=FakeListChatModel(responses=["An answer."])):
+            return [e["type"] for e in [event async for event in ask_stream("u1", "what?")]]
+
+    answered = await events([make_doc()])
+    assert answered[0] == "citations" and set(answered[1:]) == {"token"}
+    assert await events([]) == ["citations", "token"]
+    assert await events([], entry=None) == ["citations", "token"]
+
+
+@pytest.mark.asyncio
+async def test_pool_rolls_back_a_failed_write(tmp_path):
+    import sqlite3
+    from app.db import ConnectionPool, init_schema, insert_chunks
+
+    def chunk(i):
+        return {"id": f"c{i}", "doc_id": "d1", "user_id": "u1", "parent_idx": 0, "child_idx": i,
+                "parent_text": "parent", "child_text": "child", "source": "f.txt"}
+
+    pool = ConnectionPool(min_size=1, max_size=1)
+    with patch("app.db.settings.db_path", str(tmp_path / "t.db")):
+        async with pool.acquire() as conn:
+            await init_schema(conn)
+        with pytest.raises(sqlite3.IntegrityError):
+            async with pool.acquire() as conn:
+                await insert_chunks(conn, [chunk(1), chunk(2), chunk(1)])
+        async with pool.acquire() as conn:
+            assert not conn.in_transaction
+            await conn.commit()
+            cursor = await conn.execute("SELECT COUNT(*) FROM chunks")
+            assert (await cursor.fetchone())[0] == 0
+    await pool.close()
+
+
+@pytest.mark.asyncio
+async def test_parent_map_cached_until_chunks_change(tmp_path):
+    import aiosqlite
+    from app.db import (
+        cached_chunk_count, cached_parent_map, delete_document_chunks, get_chunk_count_for_user,
+        get_parent_map, init_schema, insert_chunks,
+    )
+
+    def chunk(doc_id, p):
+        return {"id": f"{doc_id}-{p}", "doc_id": doc_id, "user_id": "u1", "parent_idx": p, "child_idx": 0,
+                "parent_text": f"{doc_id} parent {p}", "child_text": "child", "source": "f.txt"}
+
+    async with aiosqlite.connect(tmp_path / "t.db") as conn:
+        conn.row_factory = aiosqlite.Row
+        await init_schema(conn)
+        await insert_chunks(conn, [chunk("d1", 0), chunk("d1", 1)])
+
+        first = await get_parent_map(conn, "u1")
+        assert cached_parent_map("u1") is first
+        assert cached_parent_map("u1", (1, 2)) is None
+        assert await get_parent_map(conn, "u1", refresh=True) is not first
+        assert first[("d1", 1)] == "d1 parent 1"
+
+        await insert_chunks(conn, [chunk("d2", 0)])
+        assert cached_parent_map("u1") is None
+        assert ("d2", 0) in await get_parent_map(conn, "u1")
+
+        assert await get_chunk_count_for_user(conn, "u1") == 3
+        assert cached_chunk_count("u1") == 3
+        # Another worker's write shows up only as a new index stamp.
+        assert cached_chunk_count("u1", (1, 2)) is None
+
+        await delete_document_chunks(conn, "u1", "d1")
+        assert cached_chunk_count("u1") is None
+        assert set(await get_parent_map(conn, "u1")) == {("d2", 0)}
+        assert await get_chunk_count_for_user(conn, "u1") == 1
+
+
+def test_bm25_index_extend_matches_rank_bm25(tmp_path):
+    from rank_bm25 import BM25Okapi
+    from app.core.bm25 import BM25Index, load_index, save_index
+
+    texts = ["the cat sat", "the dog ran far", "cat and dog", "a bird flew over the cat"]
+    index = BM25Index.build(texts[:2]).extend(texts[2:])
+    path = str(tmp_path / "bm25_index.mpk")
+    save_index(index, path)
+    reloaded = load_index(path)
+
+    expected = BM25Okapi([t.split() for t in texts]).get_scores("cat dog unknown".split())
+    assert reloaded.n_docs == 4
+    assert reloaded.scores("cat dog unknown") == pytest.approx(expected, abs=1e-5)
+
+    import numpy as np
+    pruned = reloaded.remove(np.array([True, False, True, False]))
+    expected = BM25Okapi([texts[0].split(), texts[2].split()]).get_scores("cat dog".split())
+    assert set(pruned.vocab) == set(BM25Index.build([texts[0], texts[2]]).vocab)
+    assert pruned.scores("cat dog") == pytest.approx(expected, abs=1e-5)
+
+
+def test_semantic_cache_matches_paraphrase_with_same_chunks():
+    import numpy as np
+    from app.core.cache import SemanticCache
+
+    cache = SemanticCache(maxsize=2)
+    rng = np.random.default_rng(1)
+    base = rng.standard_normal(64)
+    paraphrase = base + 0.01 * rng.standard_normal(64)
+    chunks = frozenset({("d1", 0, 0), ("d1", 0, 1)})
+    cache.store("u1", "stamp", base, chunks, {"answer": "a", "citations": []})
+
+    assert cache.lookup("u1", "stamp", paraphrase, chunks) == {"answer": "a", "citations": []}
+    assert cache.lookup("u1", "newer-stamp", paraphrase, chunks) is None
+    assert cache.lookup("u2", "stamp", paraphrase, chunks) is None
+    assert cache.lookup("u1", "stamp", paraphrase, frozenset({("d2", 0, 0)})) is None
+    assert cache.lookup("u1", "stamp", rng.standard_normal(64), chunks) is None
+
+    cache.store("u1", "stamp", rng.standard_normal(64), chunks, {"answer": "b", "citations": []})
+    cache.store("u1", "stamp", rng.standard_normal(64), chunks, {"answer": "c", "citations": []})
+    assert cache.lookup("u1", "stamp", paraphrase, chunks) is None  # evicted as least recently used
+
+
+@pytest.mark.asyncio
+async def test_rerank_batcher_coalesces_concurrent_requests():
+    import asyncio
+    from app.core.rerank import RerankBatcher
+
+    model = MagicMock()
+    model.score.side_effect = lambda pairs: [float(len(p)) for _, p in pairs]
+    batcher = RerankBatcher(model, window=0.05)
+    docs = [Document(page_content="x" * n) for n in (1, 3, 2)]
+    try:
+        ranked, scores = await asyncio.gather(
+            batcher.rerank("q1", docs, top_n=2),
+            batcher.score([("q2", "abcd")]),
+        )
+    finally:
+        await batcher.close()
+
+    model.score.assert_called_once()
+    assert [d.page_content for d in ranked] == ["xxx", "xx"]
+    assert scores == [4.0]
+
+
+def test_bm25_filter_fills_top_k_from_matching_docs():
+    from app.core.bm25 import BM25Index, SparseBM25Retriever
+    from app.core.retriever import _metadata_predicate
+
+    docs = [make_doc("a.pdf"), make_doc("b.pdf"), make_doc("b.pdf"), make_doc("a.pdf")]
+    for d, text in zip(docs, ["glue glue score", "glue score", "glue", "score only"]):
+        d.page_content = text
+    retriever = SparseBM25Retriever(docs=docs, index=BM25Index.build([d.page_content for d in docs]), k=2)
+
+    filtered = retriever.copy(update={"filter": _metadata_predicate(filter_source="b.pdf")})
+    assert {d.page_content for d in filtered.invoke("glue score")} == {"glue score", "glue"}
+    assert len(retriever.invoke("glue score")) == 2
+    assert _metadata_predicate() is None